@@ -5,6 +5,11 @@
 
 import sys
 import struct
+import binascii
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 stdch = (u'␀·········␊··␍··'
          u'················'
@@ -76,80 +81,209 @@ shpch = (u'␀☺☻♥♦♣♠•◘○◙♂♀♪♫☼'
 
 
 
+# Compiled formats for unpack
+_structs = {}
+
 def unpack(fmt, buf):
     """Unpack buf based on fmt, return the rest as a string."""
 
-    size = struct.calcsize(fmt)
-    vals = struct.unpack(fmt, str(buf[:size]))
+    try:
+        st = _structs[fmt]
+    except KeyError:
+        st = _structs[fmt] = struct.Struct(fmt)
+    size = st.size
+    vals = st.unpack(str(buf[:size]))
     return vals + (buf[size:],)
 
 
-class HexDumper:
-    def __init__(self, fd=sys.stdout):
-        self.fd = fd
-        self.offset = 0
-        self.buf = []
+# translate() tables for single-octet XOR keys
+_xor_tables = {}
+
+def xor(data, mask, offset=0):
+    """XOR data with mask, repeated, starting offset octets into mask.
+
+    data can be a string, a buffer, or a sequence of characters.  mask
+    can be a string, a sequence of octet values, or one octet value.
+    Returns a string.
+
+    """
+
+    if isinstance(mask, (int, long)):
+        mask = chr(mask)
+    elif not isinstance(mask, str):
+        mask = ''.join(chr(m) for m in mask)
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    elif isinstance(data, (bytearray, buffer)):
+        data = str(data)
+    elif not isinstance(data, str):
+        # Anything but characters raises TypeError
+        data = ''.join(data)
+    n = len(data)
+    m = len(mask)
+    if not n:
+        return ''
+    if m == 1:
+        table = _xor_tables.get(mask)
+        if table is None:
+            k = ord(mask)
+            table = _xor_tables[mask] = ''.join(chr(i ^ k) for i in xrange(256))
+        return data.translate(table)
+    offset %= m
+    mask = mask[offset:] + mask[:offset]
+    mask = (mask * (n // m + 1))[:n]
+    if numpy:
+        a = numpy.frombuffer(data, numpy.uint8) ^ numpy.frombuffer(mask, numpy.uint8)
+        return a.tostring()
+    v = int(binascii.hexlify(data), 16) ^ int(binascii.hexlify(mask), 16)
+    return binascii.unhexlify('%0*x' % (n * 2, v))
+
+
+# Lookups for HexDumper: 256 is a gap, 257 is past the end of a line
+_GAP = 256
+_PAD = 257
+_hexes = ['%02x' % i for i in range(256)] + ['--', '  ']
+_glyphs = [c.encode('utf-8') for c in cgach] + [u'◌'.encode('utf-8'), '']
+_hexline = ('%08x  ' + ' '.join(['%s'] * 8) + '  ' + ' '.join(['%s'] * 8) +
+         '  ┆%s┆\n')
 
-    def _to_printable(self, c):
-        if not c:
-            return u'◌'
-        else:
-            return cgach[ord(c)]
-
-
-    def write(self, what):
-        self.fd.write(what.encode('utf-8'))
+class HexDumper:
+    """Write a hex dump, 16 bytes to a line.
 
-    def _flush(self):
-        if not self.buf:
-            return
+    Feed it strings with dump() and runs of missing bytes with
+    dump_gap(), or a byte at a time with dump_chr() and dump_drop(),
+    then call finish().  Output is buffered until finish.
 
-        o = []
-        for c in self.buf:
-            if c:
-                o.append(u'%02x' % ord(c))
-            else:
-                o.append(u'--')
-        o +=  ([u'  '] * (16 - len(self.buf)))
-        p = [self._to_printable(c) for c in self.buf]
+    With elide, a line the same as the one before it is written as a
+    single '*', like hexdump -C.  Nothing past max_lines lines is
+    written, but the final offset still counts everything.
 
-        self.write(u'%08x  ' % self.offset)
+    """
 
-        self.write(u' '.join(o[:8]))
-        self.write(u'  ')
-        self.write(u' '.join(o[8:]))
+    bufsize = 1 << 16
 
-        self.write(u'  ┆')
+    def __init__(self, fd=sys.stdout, max_lines=None, elide=False):
+        self.fd = fd
+        self.offset = 0
+        self.buf = []
+        self.max_lines = max_lines
+        self.elide = elide
+        self.lines = 0
+        self.last = None
+        self.starred = False
+        self.truncated = False
+        self.out = []
+        self.outlen = 0
+
+    def _write(self, s):
+        self.out.append(s)
+        self.outlen += len(s)
+        if self.outlen >= self.bufsize:
+            self.fd.write(''.join(self.out))
+            self.out = []
+            self.outlen = 0
 
-        self.write(u''.join(p))
+    def write(self, what):
+        self._write(what.encode('utf-8'))
 
-        self.write(u'┆\n')
+    def _row(self, row, n):
+        # row is 16 lookup indexes, n of them real
+        if self.truncated:
+            self.offset += n
+            return
+        if self.elide and (n == 16):
+            key = tuple(row)
+            if key == self.last:
+                if not self.starred:
+                    self._write('*\n')
+                    self.starred = True
+                self.offset += n
+                return
+            self.last = key
+            self.starred = False
+        if (self.max_lines is not None) and (self.lines >= self.max_lines):
+            self._write('...\n')
+            self.truncated = True
+            self.offset += n
+            return
+        self.lines += 1
+        self._write(_hexline % ((self.offset,) +
+                             tuple(map(_hexes.__getitem__, row)) +
+                             (''.join(map(_glyphs.__getitem__, row)),)))
+        self.offset += n
 
-        self.offset += len(self.buf)
+    def _flush(self):
+        n = len(self.buf)
+        if not n:
+            return
+        self._row(self.buf + [_PAD] * (16 - n), n)
         self.buf = []
 
+    def dump(self, data):
+        """Dump a string, buffer, or anything else bytearray takes"""
+
+        data = bytearray(data)
+        i = 0
+        if self.buf:
+            i = min(16 - len(self.buf), len(data))
+            self.buf.extend(data[:i])
+            if len(self.buf) == 16:
+                self._flush()
+        if self.truncated:
+            self.offset += len(data) - i
+            return
+        end = len(data) - (len(data) - i) % 16
+        for j in xrange(i, end, 16):
+            self._row(data[j:j+16], 16)
+        self.buf.extend(data[end:])
+
+    def dump_gap(self, count):
+        """Dump a run of count missing bytes"""
+
+        i = 0
+        if self.buf:
+            i = min(16 - len(self.buf), count)
+            self.buf.extend([_GAP] * i)
+            if len(self.buf) == 16:
+                self._flush()
+        lines = (count - i) // 16
+        row = [_GAP] * 16
+        if lines:
+            self._row(row, 16)
+            lines -= 1
+        # Once a line is starred or cut off, the rest of the run is too
+        while lines and not (self.starred or self.truncated):
+            self._row(row, 16)
+            lines -= 1
+        self.offset += 16 * lines
+        self.buf.extend([_GAP] * ((count - i) % 16))
+
     def dump_chr(self, c):
-        self.buf.append(c)
+        self.buf.append(ord(c))
         if len(self.buf) == 16:
             self._flush()
 
     def dump_drop(self):
-        self.buf.append(None)
+        self.buf.append(_GAP)
         if len(self.buf) == 16:
             self._flush()
 
     def finish(self):
         self._flush()
-        self.write('%08x\n' % self.offset)
+        self._write('%08x\n' % self.offset)
+        self.fd.write(''.join(self.out))
+        self.out = []
+        self.outlen = 0
 
 
-def hexdump(buf, f=sys.stdout):
+def hexdump(buf, f=sys.stdout, max_lines=None, elide=False):
     "Print a hex dump of buf"
 
-    d = HexDumper()
-
-    for c in buf:
-        d.dump_chr(c)
+    if hasattr(buf, 'hexdump'):
+        # GapString knows where its gaps are
+        return buf.hexdump(f, max_lines, elide)
+    d = HexDumper(f, max_lines, elide)
+    d.dump(buf)
     d.finish()
 
 
@@ -178,6 +312,15 @@ def assert_in(a, *b):
 
 class BitVector:
     def __init__(self, i=0, length=None):
+        self._str = None
+        if isinstance(i, str):
+            self._val = int(binascii.hexlify(i) or '0', 16)
+            if length is not None:
+                self._len = length
+            else:
+                self._len = len(i) * 8
+                self._str = i
+            return
         try:
             self._val = 0
             for c in i:
@@ -223,17 +366,20 @@ class BitVector:
             v >>= 1
 
     def __str__(self):
-        r = ''
-        v = self._val
-        i = self._len
-        while i > 8:
-            o = ((v >> (i - 8)) & 0xFF)
-            r += chr(o)
-            i -= 8
-        if i > 0:
-            o = v & ((1 << i) - 1)
-            r += chr(o)
-        return r
+        """Whole bytes from the top, then a byte of whatever bits are left"""
+
+        if self._str is None:
+            if self._len <= 0:
+                self._str = ''
+            else:
+                full = (self._len - 1) // 8
+                low = self._len - (full * 8)
+                r = ''
+                if full:
+                    top = (self._val >> low) & ((1 << (full * 8)) - 1)
+                    r = binascii.unhexlify('%0*x' % (full * 2, top))
+                self._str = r + chr(self._val & ((1 << low) - 1))
+        return self._str
 
     def __int__(self):
         return self._val
@@ -287,34 +433,48 @@ def from_b64(s, alphabet, codec='base64'):
     return t.decode(codec)
 
 class Esab64Codec(codecs.Codec):
-    """Little-endian version of base64."""
+    """Little-endian version of base64.
+
+    Each 4 characters c0..c3 hold the 24-bit little-endian number
+    c0 | c1<<6 | c2<<12 | c3<<18.  That's base64 of the characters in
+    reverse, with each 3 bytes reversed, so binascii does the work.
+
+    """
 
     ## This could be made nicer by better conforming to the codecs.Codec
     ## spec.  For instance, raising the appropriate exceptions.
-    ##
-    ## Using BitVector makes the code very readable, but it is probably
-    ## slow.
 
     b64_chars = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/'
+
     def decode(self, input, errors='strict'):
-        r = []
-        for i in range(0, len(input), 4):
-            v = BitVector()
-            for c in input[i:i+4]:
-                if c in ('=', ' ', '\n'):
-                    break
-                v += BitVector(self.b64_chars.index(c), 6)
-
-            # Normal base64 would start at the beginning
-            b = (v[10:12] + v[ 0: 6] +
-                 v[14:18] + v[ 6:10] +
-                 v[18:24] + v[12:14])
-
-            r.append(str(b))
-        return ''.join(r), len(input)
+        s = str(input).translate(None, '= \t\r\n')
+        if s.translate(None, self.b64_chars):
+            raise ValueError('Invalid esab64 character')
+        s = s.translate(string.maketrans(self.b64_chars, b64alpha))
+        n = len(s) * 6 // 8
+        s += 'A' * (-len(s) % 4)
+        r = bytearray(len(s))
+        for i in range(4):
+            r[i::4] = s[3-i::4]
+        t = binascii.a2b_base64(str(r))
+        r = bytearray(len(t))
+        for i in range(3):
+            r[i::3] = t[2-i::3]
+        return str(r[:n]), len(input)
 
     def encode(self, input, errors='strict'):
-        raise NotImplementedError()
+        s = str(input)
+        n = (len(s) * 8 + 5) // 6
+        s += '\0' * (-len(s) % 3)
+        r = bytearray(len(s))
+        for i in range(3):
+            r[i::3] = s[2-i::3]
+        t = binascii.b2a_base64(str(r))[:-1]
+        r = bytearray(len(t))
+        for i in range(4):
+            r[i::4] = t[3-i::4]
+        r = str(r[:n]).translate(string.maketrans(b64alpha, self.b64_chars))
+        return r + '=' * (-n % 4), len(input)
 
 
 class Esab64StreamWriter(Esab64Codec, codecs.StreamWriter):
@@ -6,6 +6,18 @@
 
 from sets import Set
 from pprint import pprint
+from fractions import gcd
+import os
+import cPickle
+import math
+import random
+import string
+import multiprocessing
+import __init__
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # From Wikipedia article "Letter Frequencies"
 english_frequency = {'A': .08167,
@@ -54,63 +66,183 @@ def basedist(l):
 ##
 
 
+def sieve(limit):
+    """Return a list of the primes below limit"""
+
+    s = bytearray([1]) * limit
+    s[:2] = bytearray(2)
+    for i in xrange(2, int(limit ** 0.5) + 1):
+        if s[i]:
+            s[i * i::i] = bytearray(len(xrange(i * i, limit, i)))
+    return [i for i in xrange(limit) if s[i]]
+
+small_primes = sieve(1000)
+
+# Miller-Rabin with these bases is exact below 3.3 * 10**24, and
+# wrong with odds of at most 4**-13 above that
+_witnesses = small_primes[:13]
+
 def isPrime(number):
-    for x in range(2, number):
-        if number % x == 0:
-            return True
+    if number < 2:
+        return False
+    for p in small_primes:
+        if number % p == 0:
+            return number == p
+    if number < small_primes[-1] ** 2:
+        return True
+
+    d = number - 1
+    s = 0
+    while d % 2 == 0:
+        d //= 2
+        s += 1
+    for a in _witnesses:
+        x = pow(a, d, number)
+        if x == 1 or x == number - 1:
+            continue
+        for i in xrange(s - 1):
+            x = x * x % number
+            if x == number - 1:
+                break
         else:
-            if number - 1 == x:
-                return False
+            return False
+    return True
 
-def smallestFactor(number):
-    for x in range(2, number):
-        if number % x == 0:
-            return x
+def _rho(n):
+    """Find some factor of composite n (Brent's Pollard rho)"""
+
+    c = 1
+    while True:
+        y = 2
+        r = 1
+        q = 1
+        g = 1
+        while g == 1:
+            x = y
+            for i in xrange(r):
+                y = (y * y + c) % n
+            k = 0
+            while k < r and g == 1:
+                ys = y
+                for i in xrange(min(128, r - k)):
+                    y = (y * y + c) % n
+                    q = q * abs(x - y) % n
+                g = gcd(q, n)
+                k += 128
+            r *= 2
+        if g == n:
+            # Overshot; go back one step at a time
+            g = 1
+            while g == 1:
+                ys = (ys * ys + c) % n
+                g = gcd(abs(x - ys), n)
+        if g != n:
+            return g
+        c += 1
 
 def factor(number):
     """Return prime factors for number"""
 
+    if number < 2:
+        return [number]
     factors = []
-    while isPrime(number):
-        newFactor = smallestFactor(number)
-        factors.append(newFactor)
-        number = number / newFactor
-    factors.append(number)
+    for p in small_primes:
+        while number % p == 0:
+            factors.append(p)
+            number //= p
+    todo = [number]
+    while todo:
+        n = todo.pop()
+        if n == 1:
+            continue
+        if isPrime(n):
+            factors.append(n)
+        else:
+            d = _rho(n)
+            todo.extend((d, n // d))
+    factors.sort()
     return factors
 
+def smallestFactor(number):
+    return factor(number)[0]
+
+def divisors(number):
+    """Return every positive divisor of number, in order"""
+
+    if number < 1:
+        raise ValueError('Divisors of %d' % number)
+    ret = [1]
+    if number == 1:
+        return ret
+    factors = factor(number)
+    for p in set(factors):
+        ret = [d * p ** e for d in ret for e in xrange(factors.count(p) + 1)]
+    ret.sort()
+    return ret
+
 
 ##
 ## Statistical analysis
 ##
 
 def where(haystack, needle):
+    """Return every position of needle in haystack, overlaps and all"""
+
     ret = []
-    while True:
-        pos = haystack.find(needle)
-        if pos == -1:
-            break
+    pos = haystack.find(needle)
+    while pos != -1:
         ret.append(pos)
-        haystack = haystack[pos + 1:]
+        pos = haystack.find(needle, pos + 1)
     return ret
 
 
-def ngrams(n, haystack, min=2, repeats=False):
+def ngrams(n, haystack, min=2, repeats=False, positions=True):
+    """Return {n-gram: [positions]} for n-grams appearing min times or more.
+
+    With repeats, only n-grams of one character over and over count.
+    Without positions, values are counts instead of lists.
+
+    """
+
+    if numpy and (not positions) and (n <= 8) and (len(haystack) >= n):
+        return _ngram_counts(n, haystack, min, repeats)
     acc = {}
-    for i in range(len(haystack)):
-        rtxt = haystack[i:]
-        needle = rtxt[:n]
-        if repeats:
-            c = needle[0]
-            for d in needle:
-                if d != c:
-                    break
-            if d != c:
-                continue
-        if not acc.has_key(needle):
-            found = where(rtxt, needle)
-            if len(found) >= min:
-                acc[needle] = found
-    return acc
+    for i in xrange(len(haystack) - n + 1):
+        needle = haystack[i:i + n]
+        if repeats and (needle != needle[0] * n):
+            continue
+        try:
+            acc[needle].append(i)
+        except KeyError:
+            acc[needle] = [i]
+    ret = {}
+    for (needle, found) in acc.iteritems():
+        if len(found) >= min:
+            if positions:
+                ret[needle] = found
+            else:
+                ret[needle] = len(found)
+    return ret
+
+def _ngram_counts(n, haystack, min, repeats):
+    # Pack each n-gram into an integer, and count those
+    a = numpy.frombuffer(haystack, numpy.uint8).astype(numpy.uint64)
+    m = len(a) - n + 1
+    keys = numpy.zeros(m, numpy.uint64)
+    for j in xrange(n):
+        keys = (keys << numpy.uint64(8)) | a[j:j + m]
+    idx = None
+    if repeats:
+        idx = numpy.flatnonzero(keys == a[:m] * numpy.uint64(int('01' * n, 16)))
+        keys = keys[idx]
+    (keys, first, counts) = numpy.unique(keys, return_index=True, return_counts=True)
+    if idx is not None:
+        first = idx[first]
+    ret = {}
+    for (pos, count) in zip(first.tolist(), counts.tolist()):
+        if count >= min:
+            ret[haystack[pos:pos + n]] = count
+    return ret
 
 
 def freq(txt):
@@ -178,8 +310,18 @@ def rot(n, txt):
     return out
 
 
+def _add_table(n):
+    return ''.join(chr((i + n) % 256) for i in xrange(256))
+
+def _chars(txt):
+    """txt as a string, if it's any sequence of characters"""
+
+    if isinstance(txt, str):
+        return txt
+    return ''.join(txt)
+
 def caesar(n, txt):
-    return [chr((ord(c) + n) % 256) for c in txt]
+    return list(_chars(txt).translate(_add_table(n)))
 
 def caesars(txt):
     return [caesar(i, txt) for i in range(256)]
@@ -191,8 +333,7 @@ tabula_recta = caesars('ABCDEFGHIJKLMNOPQRSTUVWXYZ')
 def xor(n, txt):
     if n == 0:
         return txt
-    out = [(chr(ord(c) ^ n)) for c in txt]
-    return ''.join(out)
+    return __init__.xor(txt, n)
 
 def xors(txt):
     ret = []
@@ -202,11 +343,7 @@ def xors(txt):
 
 
 def add(n, txt):
-    out = ''
-    for c in txt:
-        o = (ord(c) + 256 + n) % 256    # Add 256 in case n < 0
-        out += chr(o)
-    return out
+    return _chars(txt).translate(_add_table(n))
 
 def adds(txt):
     ret = []
@@ -215,6 +352,87 @@ def adds(txt):
     return ret
 
 
+# Letters and their expected frequencies, for scoring
+_letters = sorted(english_frequency)
+_expected = [english_frequency[c] for c in _letters]
+_cases = [ord(c) for c in _letters] + [ord(c) + 32 for c in _letters]
+_printable = [9, 10, 13] + range(32, 127)
+
+def _histogram(txt):
+    if numpy:
+        return numpy.bincount(numpy.frombuffer(txt, numpy.uint8), minlength=256)
+    return [txt.count(chr(i)) for i in xrange(256)]
+
+def _counts(h, how, octets):
+    """For each key, how many of each of octets it would turn txt into"""
+
+    if numpy:
+        keys = numpy.arange(256)[:, None]
+        octets = numpy.array(octets)[None, :]
+        if how == 'xor':
+            return h[keys ^ octets]
+        return h[(octets - keys) % 256]
+    if how == 'xor':
+        return [[h[o ^ k] for o in octets] for k in xrange(256)]
+    return [[h[(o - k) % 256] for o in octets] for k in xrange(256)]
+
+def _score(h, n, how, score):
+    if score == 'chi2':
+        c = _counts(h, how, _cases)
+        if numpy:
+            exp = n * numpy.array(_expected)
+            return (((c[:, :26] + c[:, 26:] - exp) ** 2) / exp).sum(1).tolist()
+        exp = [n * f for f in _expected]
+        return [sum((a + b - e) ** 2 / e for (a, b, e) in zip(r[:26], r[26:], exp))
+                for r in c]
+    c = _counts(h, how, _printable)
+    if numpy:
+        return (1 - c.sum(1) / n).tolist()
+    return [1 - sum(r) / n for r in c]
+
+def keyscores(txt, how='xor', score='chi2'):
+    """Score every single-octet key for txt; lower is better.
+
+    how is 'xor' or 'add' (which is also caesar).  score is 'chi2',
+    the chi-square distance of the letters from english_frequency,
+    or 'printable', the fraction of octets that aren't printable.
+
+    Each key just moves the counts in txt's histogram around, so
+    nothing gets decrypted.  Returns a list of 256 scores.
+
+    """
+
+    return _score(_histogram(txt), float(len(txt)) or 1.0, how, score)
+
+# Fraction of unprintable octets over the least, past which best()
+# ranks a key after the rest
+best_slack = 0.02
+
+def best(txt, how='xor', count=5, score='chi2'):
+    """Return [(score, key, text)] for the count best keys for txt.
+
+    With the chi-square score, keys that leave more than best_slack
+    more of txt unprintable than the most printable key does (like add
+    keys 32 off, which turn spaces into NULs) go after all the others.
+    Keys with the same chi-square (like xor keys that only swap case)
+    are put in order of how printable they come out.
+
+    """
+
+    h = _histogram(txt)
+    n = float(len(txt)) or 1.0
+    scores = _score(h, n, how, score)
+    if score == 'chi2':
+        bad = _score(h, n, how, 'printable')
+        cutoff = min(bad) + best_slack
+        order = lambda k: (bad[k] > cutoff, round(scores[k], 6), bad[k])
+    else:
+        order = scores.__getitem__
+    keys = sorted(xrange(256), key=order)[:count]
+    f = {'xor': xor, 'add': add}[how]
+    return [(scores[k], k, f(k, txt)) for k in keys]
+
+
 class XorMask:
     def __init__(self, mask, stick=False):
         self.offset = 0
@@ -225,50 +443,81 @@ class XorMask:
         self.stick = stick
 
     def __call__(self, s):
-        r = []
-        offset = self.offset
-        for c in s:
-            o = ord(c)
-            r.append(chr(o ^ self._mask[offset]))
-            offset = (offset + 1) % len(self._mask)
+        r = __init__.xor(s, self._mask, self.offset)
         if self.stick:
-            self.offset = offset
-        return ''.join(r)
+            self.offset = (self.offset + len(s)) % len(self._mask)
+        return r
 
 
 ##
 ## Grep-like things within dictionary
 ##
-def matches(str, tgt):
-    if len(str) != len(tgt):
-        return False
-    map = {}
-    rmap = {}
-    for i in range(len(str)):
-        s = str[i]
-        t = tgt[i]
-        m = map.get(s)
-        if m and m != t:
-            return False
-        map[s] = t
 
-        r = rmap.get(t)
-        if r and r != s:
-            return False
-        rmap[t] = s
+# Word list for guess(), and where to keep its index
+wordlist = '/usr/share/dict/words'
+wordlist_index = os.path.expanduser('~/.crypto-words.idx')
 
-    return True
+_word_index = None
 
-def guess(pattern):
-    ret = []
+def signature(word):
+    """Return the pattern of repeated letters in word: 'that' -> 'ABCA'"""
+
+    seen = {}
+    return ''.join(seen.setdefault(c, chr(65 + len(seen))) for c in word)
+
+def matches(str, tgt):
+    return signature(str) == signature(tgt)
+
+def build_word_index():
+    """Return {signature: [words]} for every word in wordlist, lowercased"""
+
+    index = {}
+    seen = set()
+    for word in file(wordlist):
+        word = word.strip().lower()
+        if word and word not in seen:
+            seen.add(word)
+            index.setdefault(signature(word), []).append(word)
+    return index
+
+def word_index():
+    """Return the word index, loading it or building it the first time.
+
+    The index is saved in wordlist_index, and built again whenever
+    wordlist changes.
+
+    """
+
+    global _word_index
+
+    if _word_index is None:
+        st = os.stat(wordlist)
+        stamp = (st.st_mtime, st.st_size)
+        try:
+            (saved, index) = cPickle.load(file(wordlist_index, 'rb'))
+            if saved != stamp:
+                index = None
+        except (IOError, EOFError, ValueError, cPickle.UnpicklingError):
+            index = None
+        if index is None:
+            index = build_word_index()
+            try:
+                cPickle.dump((stamp, index), file(wordlist_index, 'wb'), 2)
+            except IOError:
+                pass
+        _word_index = index
+    return _word_index
+
+def guesses(patterns):
+    """Return {pattern: [words]} for each pattern"""
+
+    index = word_index()
+    return dict((p, index.get(signature(p.lower()), [])) for p in patterns)
 
-    pattern = pattern.lower()
-    words = file('/usr/share/dict/words')
-    for word in words:
-        word = word.strip()
-        word = word.lower()
-        if matches(word, pattern):
-            print word
+def guess(pattern):
+    ret = guesses([pattern])[pattern]
+    for word in ret:
+        print word
     return ret
 
 ##
@@ -280,24 +529,24 @@ def summary(txt):
     print "Factors", factor(len(txt))
     print
     print "Frequency (etaoin shrdlcu)"
-    freqgraph(freq(txt))
+    freqgraph(ngrams(1, txt, min=0, positions=False))
     print
 
     print "Bigrams (th er on an re he in ed nd ha at en es of or"
     print "         nt ea ti to it st io le is ou ar as de rt ve)"
-    freqgraph(bigrams(txt))
+    freqgraph(ngrams(2, txt, positions=False))
     print
 
     print "Trigrams (the and tha ent ion tio for nde has nce edt"
     print "          tis oft sth men)"
-    freqgraph(trigrams(txt))
+    freqgraph(ngrams(3, txt, positions=False))
     print
 
     # 4-letter words: that with have this will your from they know
     #                 want been good much some time
 
     print "Repeats (ss ee tt ff ll mm oo)"
-    freqgraph(ngrams(2, txt, min=1, repeats=True))
+    freqgraph(ngrams(2, txt, min=1, repeats=True, positions=False))
     print
 
     print "Unique neighbors"
@@ -309,3 +558,240 @@ def replace(txt, orig, repl):
     for o, r in zip(orig, repl):
         txt = txt.replace(o, r)
     return txt
+
+
+##
+## Solvers
+##
+
+_alphabet = string.ascii_uppercase
+_upper = string.maketrans(string.ascii_lowercase, string.ascii_uppercase)
+_nonletters = ''.join(chr(i) for i in xrange(256) if chr(i) not in string.ascii_letters)
+
+def letters(txt):
+    """Return just the letters of txt, in upper case"""
+
+    return txt.translate(_upper, _nonletters)
+
+def ioc(txt):
+    """Index of coincidence of the letters in txt (English is about .066)"""
+
+    txt = letters(txt)
+    n = len(txt)
+    if n < 2:
+        return 0.0
+    return sum(c * (c - 1) for c in (txt.count(l) for l in _alphabet)) / float(n * (n - 1))
+
+def kasiski(txt, maxlen=20, n=3):
+    """Return {key length: votes} from the gaps between repeated n-grams"""
+
+    votes = {}
+    for found in ngrams(n, letters(txt)).itervalues():
+        for (a, b) in zip(found, found[1:]):
+            for d in divisors(b - a):
+                if 2 <= d <= maxlen:
+                    votes[d] = votes.get(d, 0) + 1
+    return votes
+
+def keylengths(txt, maxlen=20):
+    """Return [(average column IoC, key length)], best first"""
+
+    txt = letters(txt)
+    ret = []
+    for k in xrange(1, min(maxlen, len(txt) // 2) + 1):
+        ret.append((sum(ioc(txt[i::k]) for i in xrange(k)) / k, k))
+    ret.sort(reverse=True)
+    return ret
+
+def _fit_shift(column):
+    """The shift that makes column look most like English"""
+
+    n = float(len(column)) or 1.0
+    counts = [column.count(l) for l in _alphabet]
+    best = None
+    for s in xrange(26):
+        chi2 = sum((counts[(i + s) % 26] - n * f) ** 2 / (n * f)
+                   for (i, f) in enumerate(_expected))
+        if (best is None) or (chi2 < best[0]):
+            best = (chi2, s)
+    return best[1]
+
+def unvigenere(txt, key):
+    """Decrypt txt with Vigenere key, leaving anything but letters alone"""
+
+    key = [ord(k) - 65 for k in key.upper()]
+    out = []
+    i = 0
+    for c in txt:
+        if c in string.ascii_uppercase:
+            out.append(chr((ord(c) - 65 - key[i % len(key)]) % 26 + 65))
+            i += 1
+        elif c in string.ascii_lowercase:
+            out.append(chr((ord(c) - 97 - key[i % len(key)]) % 26 + 97))
+            i += 1
+        else:
+            out.append(c)
+    return ''.join(out)
+
+def vigenere(txt, length=None, maxlen=20):
+    """Break a Vigenere cipher, returning (key, plaintext).
+
+    Without a key length, the shortest one whose columns look nearly
+    as English as the best does is used, since multiples of the right
+    length look just as good.
+
+    """
+
+    ct = letters(txt)
+    if not length:
+        lengths = keylengths(ct, maxlen)
+        if not lengths:
+            raise ValueError('Too few letters to find a key length')
+        top = lengths[0][0]
+        length = min(k for (score, k) in lengths if score >= top * .9)
+    key = ''.join(chr(65 + _fit_shift(ct[i::length])) for i in xrange(length))
+    return (key, unvigenere(txt, key))
+
+
+_quadgrams = None
+
+def quadgram_table(corpus=None):
+    """Return the log10 probability of every quadgram of letters.
+
+    Quadgram ABCD is at (((A * 26) + B) * 26 + C) * 26 + D, counting A
+    as 0.  Counted from corpus, or if there isn't one, the words in
+    wordlist (which is only done once).
+
+    """
+
+    global _quadgrams
+
+    if (corpus is None) and (_quadgrams is not None):
+        return _quadgrams
+    if corpus is None:
+        txt = letters(file(wordlist).read())
+    else:
+        txt = letters(corpus)
+    if numpy:
+        a = numpy.frombuffer(txt, numpy.uint8).astype(numpy.int64) - 65
+        idx = ((a[:-3] * 26 + a[1:-2]) * 26 + a[2:-1]) * 26 + a[3:]
+        counts = numpy.bincount(idx, minlength=26 ** 4).astype(float)
+        table = numpy.log10(numpy.maximum(counts, 0.01) / max(len(idx), 1))
+        # Half the memory to gather from, twice the keys per second
+        table = table.astype(numpy.float32)
+    else:
+        counts = [0] * 26 ** 4
+        a = [ord(c) - 65 for c in txt]
+        for i in xrange(len(a) - 3):
+            counts[((a[i] * 26 + a[i + 1]) * 26 + a[i + 2]) * 26 + a[i + 3]] += 1
+        total = float(max(len(a) - 3, 1))
+        table = [math.log10(max(c, 0.01) / total) for c in counts]
+    if corpus is None:
+        _quadgrams = table
+    return table
+
+def _score_keys(table, keys, ct):
+    # keys is a 2-D array of keys, ct an array of letter numbers
+    p = keys[:, ct]
+    idx = ((p[:, :-3] * 26 + p[:, 1:-2]) * 26 + p[:, 2:-1]) * 26 + p[:, 3:]
+    return table[idx].sum(1)
+
+def score_keys(keys, txt, table=None):
+    """Return the quadgram score of txt deciphered with each of keys.
+
+    A key is 26 letters: what cipher A through Z stand for.  Higher
+    scores look more like the quadgram table's language.
+
+    """
+
+    if table is None:
+        table = quadgram_table()
+    ct = [ord(c) - 65 for c in letters(txt)]
+    if numpy:
+        keys = numpy.frombuffer(''.join(keys).upper(), numpy.uint8)
+        keys = keys.reshape(-1, 26).astype(numpy.intp) - 65
+        return _score_keys(table, keys, numpy.array(ct)).tolist()
+    keys = [[ord(k) - 65 for k in key.upper()] for key in keys]
+    return [_score_key(table, key, ct) for key in keys]
+
+def _score_key(table, key, ct):
+    p = [key[c] for c in ct]
+    return sum(table[((p[i] * 26 + p[i + 1]) * 26 + p[i + 2]) * 26 + p[i + 3]]
+               for i in xrange(len(p) - 3))
+
+def _climb(job):
+    """Hill-climb from one random key, returning (score, key)"""
+
+    (ct, table, seed) = job
+    if table is None:
+        table = quadgram_table()
+    rand = random.Random(seed)
+    key = range(26)
+    rand.shuffle(key)
+
+    if numpy:
+        # Try every swap of two letters at once, and take the best
+        ct = numpy.array(ct)
+        (I, J) = numpy.triu_indices(26, 1)
+        rows = numpy.arange(len(I))
+        key = numpy.array(key)
+        best = _score_keys(table, key[None, :], ct)[0]
+        while True:
+            keys = numpy.repeat(key[None, :], len(I), 0)
+            keys[rows, I] = key[J]
+            keys[rows, J] = key[I]
+            scores = _score_keys(table, keys, ct)
+            i = scores.argmax()
+            if scores[i] <= best:
+                break
+            best = scores[i]
+            key = keys[i]
+        return (float(best), key.tolist())
+
+    # Try random swaps until a lot of them in a row don't help
+    best = _score_key(table, key, ct)
+    fails = 0
+    while fails < 1000:
+        (i, j) = rand.sample(xrange(26), 2)
+        key[i], key[j] = key[j], key[i]
+        score = _score_key(table, key, ct)
+        if score > best:
+            best = score
+            fails = 0
+        else:
+            key[i], key[j] = key[j], key[i]
+            fails += 1
+    return (best, key)
+
+def substitute(txt, key):
+    """Decipher txt with a substitution key (what A through Z stand for)"""
+
+    key = key.upper()
+    return txt.translate(string.maketrans(_alphabet + _alphabet.lower(),
+                                          key + key.lower()))
+
+def substitution(txt, restarts=20, processes=None, table=None):
+    """Break a simple substitution cipher, returning (score, key, plaintext).
+
+    Hill-climbs on quadgram scores from restarts random keys, in a
+    pool of that many processes if processes is given.
+
+    """
+
+    if table is None:
+        # Workers get the table by inheriting it, not through a pipe
+        quadgram_table()
+    ct = [ord(c) - 65 for c in letters(txt)]
+    jobs = [(ct, table, seed) for seed in xrange(restarts)]
+    if processes:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_climb, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map(_climb, jobs)
+    (score, key) = max(results)
+    key = ''.join(chr(65 + k) for k in key)
+    return (score, key, substitute(txt, key))
@@ -10,10 +10,40 @@ Lists should have only byte and numeric items.
 
 import __init__
 import sys
+import bisect
+import itertools
+import re
+
+def _size(i):
+    try:
+        return len(i)
+    except TypeError:
+        return i
+
+def _cut(i, start, end):
+    """Part of a chunk, from start to end (or the end of it)"""
+
+    try:
+        return i[start:end]
+    except TypeError:
+        if end is None:
+            end = i
+        return end - start
 
 class GapString:
+    """A string with gaps in it.
+
+    contents is the list of chunks: strings, and numbers for gaps of
+    that many octets.  The offset each chunk ends at is kept in _ends,
+    which catches up with contents the next time it's needed, so
+    appending stays cheap and indexing is a binary search.  Slices
+    share chunks with the original, cutting only the ones at the ends.
+
+    """
+
     def __init__(self, init=None, drop='?'):
         self.contents = []
+        self._ends = []
         self.length = 0
         self.drop = drop
 
@@ -36,21 +66,40 @@ class GapString:
         return '<GapString of length %d>' % self.length
 
     def append(self, i):
-        try:
-            self.length += len(i)
-            self.contents.append(i)
-        except TypeError:
-            self.length += i
+        n = _size(i)
+        if n:
+            self.length += n
             self.contents.append(i)
 
     def pop(self, idx=-1):
         item = self.contents.pop(idx)
-        try:
-            self.length -= item
-        except TypeError:
-            self.length -= len(item)
+        self.length -= _size(item)
+        self._ends = []
         return GapString(item)
-        
+
+    def _sync(self):
+        """Bring _ends up to date with contents, and return it"""
+
+        ends = self._ends
+        contents = self.contents
+        if len(ends) != len(contents):
+            if len(ends) > len(contents):
+                # Something took chunks out behind our back
+                ends = self._ends = []
+            total = ends and ends[-1] or 0
+            for i in contents[len(ends):]:
+                total += _size(i)
+                ends.append(total)
+        return ends
+
+    def _locate(self, pos):
+        """Return (chunk number, offset within it) of pos"""
+
+        ends = self._sync()
+        n = bisect.bisect_right(ends, pos)
+        if n:
+            return (n, pos - ends[n - 1])
+        return (0, pos)
 
     def __str__(self):
         ret = []
@@ -81,17 +130,15 @@ class GapString:
                 return True
         return False
 
-    def hexdump(self, fd=sys.stdout):
-        offset = 0
-
-        d = __init__.HexDumper(fd)
+    def hexdump(self, fd=sys.stdout, max_lines=None, elide=False):
+        d = __init__.HexDumper(fd, max_lines, elide)
         for i in self.contents:
             try:
-                for j in xrange(i):
-                    d.dump_drop()
+                len(i)
             except TypeError:
-                for c in i:
-                    d.dump_chr(c)
+                d.dump_gap(i)
+            else:
+                d.dump(i)
         d.finish()
 
     def extend(self, other):
@@ -100,64 +147,34 @@ class GapString:
 
     def __getslice__(self, start, end):
         end = min(self.length, end)
-        start = min(self.length, start)
+        start = max(min(self.length, start), 0)
 
         new = self.__class__(drop=self.drop)
-        new.length = max(end - start, 0)
-        if new.length == 0:
-            new.contents = []
+        if end <= start:
             return new
-        new.contents = self.contents[:]
-
-        l = self.length - new.length - start
-
-        # Trim off the beginning
-        while start >= 0:
-            i = new.contents.pop(0)
-            try:
-                start -= i
-                if start < 0:
-                    new.contents.insert(0, -start)
-            except TypeError:
-                start -= len(i)
-                if start < 0:
-                    new.contents.insert(0, i[start:])
-
-        # Trim off the end
-        while l >= 0:
-            i = new.contents.pop()
-            try:
-                l -= i
-                if l < 0:
-                    new.contents.append(-l)
-            except TypeError:
-                l -= len(i)
-                if l < 0:
-                    new.contents.append(i[:-l])
+        new.length = end - start
 
+        contents = self.contents
+        (i, ioffs) = self._locate(start)
+        (j, joffs) = self._locate(end - 1)
+        if i == j:
+            new.contents = [_cut(contents[i], ioffs, joffs + 1)]
+        else:
+            new.contents = contents[i:j + 1]
+            new.contents[0] = _cut(contents[i], ioffs, None)
+            new.contents[-1] = _cut(contents[j], 0, joffs + 1)
         return new
 
     def __getitem__(self, idx):
-        if False:
-            c = self[idx:idx+1]
-            if c.hasgaps():
-                return self.drop[0]
-            else:
-                return c.contents[0][0]
-        else:
-            l = 0
-            for i in self.contents:
-                try:
-                    l += len(i)
-                except TypeError:
-                    l += i
-                if l > idx:
-                    offs = idx - l
-                    try:
-                        return i[offs]
-                    except:
-                        return self.drop[0]
+        if idx < 0:
+            idx += self.length
+        if not 0 <= idx < self.length:
             raise IndexError('Out of bounds')
+        (n, offs) = self._locate(idx)
+        try:
+            return self.contents[n][offs]
+        except TypeError:
+            return self.drop[0]
 
     def __add__(self, other):
         if isinstance(other, str):
@@ -169,59 +186,103 @@ class GapString:
             return new
 
     def __xor__(self, mask):
-        try:
-            mask = [ord(c) for c in mask]
-        except TypeError:
-            pass
-        try:
-            masklen = len(mask)
-        except TypeError:
-            masklen = 1
-            mask = [mask]
-
         new = self.__class__(drop=self.drop)
         for i in self.contents:
-            try:
-                r = []
-                offset = len(new) % masklen
-                for c in i:
-                    o = ord(c)
-                    r.append(chr(o ^ mask[offset]))
-                    offset = (offset + 1) % masklen
-                new.append(''.join(r))
-            except TypeError:
+            if isinstance(i, str):
+                # Gaps still use up mask
+                new.append(__init__.xor(i, mask, new.length))
+            else:
                 new.append(i)
         return new
 
-    def index(self, needle):
-        pos = 0
-        for i in self.contents:
-            try:
-                return pos + i.index(needle)
-            except AttributeError:
-                pos += i
-            except ValueError:
-                pos += len(i)
-        raise ValueError('substring not found')
+    def _chunks(self, start=0):
+        """Generate chunks from start on"""
+
+        (n, offs) = self._locate(start)
+        contents = self.contents
+        if n < len(contents):
+            yield _cut(contents[n], offs, None)
+            for i in itertools.islice(contents, n + 1, None):
+                yield i
+
+    def finditer(self, needles, start=0):
+        """Generate (offset, needle) for each match of any of needles.
+
+        Matches are found left to right, from start on, without
+        overlapping; where several needles match at the same place, the
+        longest wins.  They may cross chunk boundaries, but never gaps,
+        since nobody knows what was in those.
+
+        """
+
+        if isinstance(needles, str):
+            needles = [needles]
+        needles = sorted(set(needles), key=len, reverse=True)
+        if not needles[-1]:
+            needles.pop()
+        if not needles:
+            return
+        search = re.compile('|'.join(re.escape(n) for n in needles)).search
+        # Matches starting this close to the end of what's been seen
+        # might turn out longer with the next chunk
+        keep = len(needles[0]) - 1
+
+        buf = ''
+        pos = start
+        for i in itertools.chain(self._chunks(start), [0]):
+            if isinstance(i, str):
+                buf += i
+                limit = len(buf) - keep
+            else:
+                limit = len(buf)
+            at = 0
+            while True:
+                m = search(buf, at)
+                if (not m) or (m.start() >= limit):
+                    break
+                yield (pos + m.start(), m.group())
+                at = m.end()
+            if isinstance(i, str):
+                at = max(at, limit, 0)
+                buf = buf[at:]
+                pos += at
+            else:
+                pos += len(buf) + i
+                buf = ''
+
+    def find(self, needle, start=0):
+        """Return the offset of needle, at or after start, or -1"""
+
+        if not needle:
+            return start
+        for (pos, _) in self.finditer(needle, start):
+            return pos
+        return -1
+
+    def index(self, needle, start=0):
+        pos = self.find(needle, start)
+        if pos < 0:
+            raise ValueError('substring not found')
+        return pos
 
     def split(self, pivot=' ', times=None):
         ret = []
-        cur = self
-        while (not times) or (len(ret) < times):
-            try:
-                pos = cur.index(pivot)
-            except ValueError:
+        pos = 0
+        for (at, match) in self.finditer(pivot):
+            if times and (len(ret) >= times):
                 break
-            ret.append(cur[:pos])
-            cur = cur[pos+len(pivot):]
-        ret.append(cur)
+            ret.append(self[pos:at])
+            pos = at + len(match)
+        ret.append(self[pos:])
         return ret
 
     def startswith(self, what):
-        return (what == str(self[:len(what)]))
+        head = self[:len(what)]
+        return (what == str(head)) and not head.hasgaps()
 
     def endswith(self, what):
-        return (what == str(self[-len(what):]))
+        tail = self[-len(what):]
+        return (what == str(tail)) and not tail.hasgaps()
 
 
 if __name__ == '__main__':
@@ -237,6 +298,29 @@ if __name__ == '__main__':
     assert str(gs + gs) == 'hi???hi???'
     assert str(gs ^ 1) == 'ih???'
 
+    gs = GapString()
+    for c in ('ab', 2, '', 'cde', 1, 'f'):
+        gs.append(c)
+    assert str(gs) == 'ab??cde?f'
+    assert ''.join(gs[i] for i in range(len(gs))) == 'ab??cde?f'
+    assert gs[-1] == 'f'
+    assert str(gs[1:6]) == 'b??cd'
+    assert str(gs[3:4]) == '?'
+    assert str(gs[4:7][1:]) == 'de'
+    assert gs[4:7].contents == ['cde']
+
+    gs = GapString()
+    for c in ('GET / HT', 'TP/1.0\r', '\nHost: x\r\n', 3, '\r\nbody'):
+        gs.append(c)
+    assert gs.index('HTTP') == 6
+    assert gs.index('\r\n') == 14
+    assert gs.find('\r\n', 15) == 23
+    assert gs.find('x\r\n???') == -1
+    assert [str(p) for p in gs.split('\r\n')] == ['GET / HTTP/1.0', 'Host: x', '???', 'body']
+    assert list(gs.finditer(['T', 'TP', 'Host'])) == [(2, 'T'), (7, 'T'), (8, 'TP'), (16, 'Host')]
+    assert gs.startswith('GET / HTTP')
+    assert not gs[:26].endswith('?\r\n')
+
     gs = GapString()
     gs.append('123456789A')
     assert str(gs[:4]) == '1234'
@@ -8,6 +8,12 @@ import struct
 import socket
 import warnings
 import heapq
+import mmap
+import multiprocessing
+import Queue
+import traceback
+import bisect
+import collections
 import gapstr
 import time
 try:
@@ -18,6 +24,12 @@ import os
 import cgi
 import urllib
 import UserDict
+import array
+import sys
+try:
+    import numpy
+except ImportError:
+    numpy = None
 from __init__ import *
 
 def unpack_nybbles(byte):
@@ -37,6 +49,47 @@ UDP  = 17
 def str_of_eth(d):
     return ':'.join([('%02x' % ord(x)) for x in d])
 
+def flow_key(saddr, sport, daddr, dport, protocol):
+    """Return an integer naming a flow, the same for both directions.
+
+    Unlike Frame.hash, no two different flows get the same key.
+
+    """
+
+    a = ((saddr & 0xffffffff) << 16) | (sport or 0)
+    b = ((daddr & 0xffffffff) << 16) | (dport or 0)
+    if a > b:
+        a, b = b, a
+    return (((a << 48) | b) << 8) | protocol
+
+def flow_endpoints(flow):
+    """Return the two (saddr, port) ends of a flow key, lower one first"""
+
+    a = flow >> 56
+    b = (flow >> 8) & 0xffffffffffff
+    # Addresses are signed, like Frame's
+    return ((int((a >> 16) ^ 0x80000000) - 0x80000000, int(a & 0xffff)),
+            (int((b >> 16) ^ 0x80000000) - 0x80000000, int(b & 0xffff)))
+
+def _flow_mix(flow):
+    """Mix the endpoint bits of a flow key into 64 bits.
+
+    The key's low bits are the protocol, and the next ones usually the
+    server port, so they can't be used as they are.
+
+    """
+
+    h = flow >> 8
+    h = (h ^ (h >> 48) ^ (h >> 96)) & 0xffffffffffff
+    h = ((h ^ (h >> 30)) * 0xbf58476d1ce4e5b9) & 0xffffffffffffffff
+    h = ((h ^ (h >> 27)) * 0x94d049bb133111eb) & 0xffffffffffffffff
+    return h ^ (h >> 31)
+
+def flow_shard(flow, n):
+    """Pick one of n shards for a flow key"""
+
+    return (_flow_mix(flow) >> 32) % n
+
 class Frame:
     """Turn an ethernet frame into relevant parts"""
 
@@ -126,6 +179,8 @@ class Frame:
             # This hash is the same for both sides of the transaction
             self.hash = (self.saddr ^ (self.sport or 0)
                          ^ self.daddr ^ (self.dport or 0))
+            self.flow = flow_key(self.saddr, self.sport,
+                                 self.daddr, self.dport, self.protocol)
         else:
             self.name = 'Ethernet type %d' % self.eth_type
             self.protocol = None
@@ -157,6 +212,293 @@ class Frame:
                                                 str_of_eth(self.ar_tha),
                                                 self.dst_addr)
 
+# Precompiled headers for LazyFrame
+_ETHTYPE = struct.Struct('!H')
+_ARPHDR = struct.Struct('!HHBBH6si6si')
+_IPHDR = struct.Struct('!BBHHHBBHii')
+_TCPHDR = struct.Struct('!HHLLBBHHH')
+_UDPHDR = struct.Struct('!HHHH')
+_ICMPHDR = struct.Struct('!BBHHH')
+
+_IP_NAMES = {TCP: 'TCP/IP', UDP: 'UDP/IP', ICMP: 'ICMP/IP'}
+
+class LazyFrame(object):
+    """Frame that decodes fields the first time they're used.
+
+    Only the Ethernet type and the IP (or ARP) header are decoded up
+    front.  Everything else is pulled out of the raw frame on demand,
+    a layer at a time.  Apart from that it behaves like Frame.
+
+    """
+
+    __slots__ = ('raw', 'time', 'time_usec', 'name', 'protocol', '_l3', '_data',
+                 'eth_dhost', 'eth_shost', 'eth_type',
+                 'ar_hrd', 'ar_pro', 'ar_hln', 'ar_pln', 'ar_op',
+                 'ar_sha', 'ar_sip', 'ar_tha', 'ar_tip',
+                 'ihlvers', 'tos', 'tot_len', 'id', 'frag_off', 'ttl', 'check',
+                 'saddr', 'daddr',
+                 'sport', 'dport', 'seq', 'ack', 'off', 'flags', 'win', 'sum', 'urp',
+                 'ulen', 'type', 'code', 'cheksum',
+                 'src', 'dst', 'hash', 'flow', 'options', 'payload')
+
+    def __init__(self, pkt):
+        ((self.time, self.time_usec, _), raw) = pkt
+        self.raw = raw
+
+        (self.eth_type,) = _ETHTYPE.unpack_from(raw, 12)
+        l3 = 14
+        if self.eth_type == VLAN:
+            (self.eth_type,) = _ETHTYPE.unpack_from(raw, 16)
+            l3 = 18
+        self._l3 = l3
+        if self.eth_type == ARP:
+            self.name, self.protocol = ('ARP', ARP)
+            (self.ar_hrd,
+             self.ar_pro,
+             self.ar_hln,
+             self.ar_pln,
+             self.ar_op,
+             self.ar_sha,
+             self.ar_sip,
+             self.ar_tha,
+             self.ar_tip) = _ARPHDR.unpack_from(raw, l3)
+            self.saddr = self.ar_sip
+            self.daddr = self.ar_tip
+        elif self.eth_type == IP:
+            (self.ihlvers,
+             self.tos,
+             self.tot_len,
+             id,
+             self.frag_off,
+             self.ttl,
+             self.protocol,
+             self.check,
+             self.saddr,
+             self.daddr) = _IPHDR.unpack_from(raw, l3)
+            if self.protocol != ICMP:
+                # ICMP has its own id
+                self.id = id
+            self.name = _IP_NAMES.get(self.protocol) or ('IP Protocol %d' % self.protocol)
+        else:
+            self.name = 'Ethernet type %d' % self.eth_type
+            self.protocol = None
+
+    def _decode_eth(self):
+        self.eth_dhost = self.raw[0:6]
+        self.eth_shost = self.raw[6:12]
+
+    def _decode_l4(self):
+        if self.eth_type != IP:
+            return
+        raw = self.raw
+        l4 = self._l3 + 20
+        if self.protocol == TCP:
+            (self.sport,
+             self.dport,
+             self.seq,
+             self.ack,
+             x2off,
+             self.flags,
+             self.win,
+             self.sum,
+             self.urp) = _TCPHDR.unpack_from(raw, l4)
+            self.off = x2off >> 4
+            opt_length = self.off * 4
+            start = l4 + 20
+            if opt_length > 20:
+                start = l4 + opt_length
+            length = self.tot_len - opt_length - 20
+            self._data = (l4 + 20, l4 + opt_length, start, length)
+            # Everybody wants TCP payloads, so don't wait to be asked
+            if length < 0:
+                length += len(raw) - start
+            self.payload = raw[start:start + max(length, 0)]
+        elif self.protocol == UDP:
+            (self.sport,
+             self.dport,
+             self.ulen,
+             self.sum) = _UDPHDR.unpack_from(raw, l4)
+            self._data = (0, 0, l4 + 8, self.ulen - 8)
+        elif self.protocol == ICMP:
+            self.sport = self.dport = None
+            (self.type,
+             self.code,
+             self.cheksum,
+             self.id,
+             self.seq) = _ICMPHDR.unpack_from(raw, l4)
+            self._data = (0, 0, l4 + 8, self.tot_len - 8)
+        else:
+            self.sport = self.dport = None
+            self._data = (0, 0, l4, len(raw) - l4)
+
+        self.src = (self.saddr, self.sport)
+        self.dst = (self.daddr, self.dport)
+
+        # This hash is the same for both sides of the transaction
+        self.hash = (self.saddr ^ (self.sport or 0)
+                     ^ self.daddr ^ (self.dport or 0))
+        self.flow = flow_key(self.saddr, self.sport,
+                             self.daddr, self.dport, self.protocol)
+
+    def _decode_data(self):
+        (ostart, oend, start, length) = self._data
+        # Negative lengths count back from the end, like Frame does
+        if length >= 0:
+            end = start + length
+        else:
+            end = len(self.raw) + length
+        if self.protocol == TCP:
+            self.options = self.raw[ostart:oend]
+        self.payload = self.raw[start:max(start, end)]
+
+    _decoders = {}
+    for k in ('eth_dhost', 'eth_shost'):
+        _decoders[k] = _decode_eth
+    for k in ('sport', 'dport', 'seq', 'ack', 'off', 'flags', 'win', 'sum', 'urp',
+              'ulen', 'type', 'code', 'cheksum', 'id', 'src', 'dst', 'hash', 'flow',
+              '_data'):
+        _decoders[k] = _decode_l4
+    for k in ('options', 'payload'):
+        _decoders[k] = _decode_data
+    del k
+
+    def __getattr__(self, name):
+        try:
+            decode = self._decoders[name]
+        except KeyError:
+            raise AttributeError(name)
+        decode(self)
+        return object.__getattribute__(self, name)
+
+    def get_src_addr(self):
+        return socket.inet_ntoa(struct.pack('!i', self.saddr))
+    src_addr = property(get_src_addr)
+
+    def get_dst_addr(self):
+        return socket.inet_ntoa(struct.pack('!i', self.daddr))
+    dst_addr = property(get_dst_addr)
+
+    def __reduce__(self):
+        # Only the raw frame is sent; the other end decodes it again
+        return (self.__class__,
+                (((self.time, self.time_usec, len(self.raw)), str(self.raw)),))
+
+    def __repr__(self):
+        if self.protocol == ARP:
+            return '<Frame %s %s(%s) -> %s(%s)>' % (self.name,
+                                                    str_of_eth(self.ar_sha),
+                                                    self.src_addr,
+                                                    str_of_eth(self.ar_tha),
+                                                    self.dst_addr)
+        return ('<Frame %s %s:%r(%08x) -> %s:%r(%08x) length %d>' %
+                (self.name,
+                 self.src_addr, self.sport, self.seq,
+                 self.dst_addr, self.dport, self.ack,
+                 len(self.payload)))
+
+
+##
+## Vectorized decoding
+##
+
+if numpy:
+    frame_dtype = numpy.dtype([('time', 'u4'), ('time_usec', 'u4'),
+                               ('eth_type', 'u2'), ('protocol', 'u1'),
+                               ('saddr', 'i4'), ('daddr', 'i4'),
+                               ('sport', 'u2'), ('dport', 'u2'),
+                               ('seq', 'u4'), ('ack', 'u4'), ('flags', 'u1'),
+                               ('hash', 'i8'), ('flow_lo', 'u8'), ('flow_hi', 'u8'),
+                               ('payload', 'u8'), ('payload_len', 'u4')])
+
+def _be(buf, pos, width):
+    """Big-endian unsigned integers of width octets at each of pos"""
+
+    v = buf[pos].astype(numpy.uint32)
+    for i in range(1, width):
+        v = (v << 8) | buf[pos + i]
+    return v
+
+def decode_batch(b):
+    """Decode the headers of a batch of records into a numpy array.
+
+    b is a batch from the pcap reader's read_batch().  Returns one
+    frame_dtype row per record, with the same values Frame would
+    give, so captures can be filtered and counted with array
+    operations.  payload is the offset of the payload in b.buf.
+    Fields that don't apply to a frame (ports of ICMP, seq of UDP, and
+    so on) are zero; protocol is zero for anything that isn't IP.
+    (protocol, flow_lo, flow_hi) is the flow key: the lower and higher
+    of the two (address << 16 | port) endpoints.
+
+    """
+
+    if not numpy:
+        raise ImportError('decode_batch needs numpy')
+
+    hdrs = numpy.frombuffer(b.hdrs, 'u%d' % b.hdrs.itemsize).reshape(-1, 5)
+    out = numpy.zeros(len(hdrs), frame_dtype)
+    if not len(hdrs):
+        return out
+    buf = numpy.frombuffer(b.buf, numpy.uint8)
+    last = len(buf) - 1
+    out['time'] = hdrs[:, 0]
+    out['time_usec'] = hdrs[:, 1]
+    start = hdrs[:, 4].astype(numpy.int64)
+    end = start + hdrs[:, 2]
+
+    def be(pos, width, ok):
+        return numpy.where(ok, _be(buf, numpy.minimum(pos, last - width + 1), width), 0)
+
+    # Ethernet
+    ok = end >= start + 14
+    eth_type = be(start + 12, 2, ok)
+    vlan = ok & (eth_type == VLAN) & (end >= start + 18)
+    eth_type = numpy.where(vlan, be(start + 16, 2, vlan), eth_type)
+    out['eth_type'] = eth_type
+    l3 = start + 14 + 4 * vlan
+
+    # IP
+    ip = (eth_type == IP) & (end >= l3 + 20)
+    protocol = be(l3 + 9, 1, ip)
+    tot_len = be(l3 + 2, 2, ip).astype(numpy.int64)
+    out['protocol'] = protocol
+    out['saddr'] = be(l3 + 12, 4, ip).view(numpy.int32)
+    out['daddr'] = be(l3 + 16, 4, ip).view(numpy.int32)
+    l4 = l3 + 20
+
+    tcp = ip & (protocol == TCP) & (end >= l4 + 20)
+    udp = ip & (protocol == UDP) & (end >= l4 + 8)
+    icmp = ip & (protocol == ICMP) & (end >= l4 + 8)
+    ports = tcp | udp
+    out['sport'] = be(l4, 2, ports)
+    out['dport'] = be(l4 + 2, 2, ports)
+    out['seq'] = be(l4 + 4, 4, tcp)
+    out['ack'] = be(l4 + 8, 4, tcp)
+    out['flags'] = be(l4 + 13, 1, tcp)
+    out['hash'] = (out['saddr'].astype(numpy.int64) ^ out['sport'] ^
+                   out['daddr'] ^ out['dport'])
+    a = (out['saddr'].view(numpy.uint32).astype(numpy.uint64) << 16) | out['sport']
+    b = (out['daddr'].view(numpy.uint32).astype(numpy.uint64) << 16) | out['dport']
+    out['flow_lo'] = numpy.minimum(a, b)
+    out['flow_hi'] = numpy.maximum(a, b)
+
+    # Payload, with Frame's idea of where it starts and how long it is
+    opt_length = (be(l4 + 12, 1, tcp) >> 4).astype(numpy.int64) * 4
+    pstart = numpy.where(tcp, l4 + numpy.maximum(opt_length, 20),
+                         numpy.where(udp | icmp, l4 + 8, l4))
+    plen = numpy.where(tcp, tot_len - opt_length - 20,
+                       numpy.where(udp, be(l4 + 4, 2, udp).astype(numpy.int64) - 8,
+                                   numpy.where(icmp, tot_len - 8, end - l4)))
+    # Negative lengths count back from the end of the record
+    plen = numpy.where(plen < 0, end + plen - pstart, plen)
+    plen = numpy.clip(plen, 0, numpy.maximum(end - pstart, 0))
+    known = ip & (tcp | udp | icmp | ((protocol != TCP) & (protocol != UDP) &
+                                      (protocol != ICMP)))
+    out['payload'] = numpy.where(known, pstart, 0)
+    out['payload_len'] = numpy.where(known, plen, 0)
+    return out
+
+
 class TCP_Recreate:
     closed = True
 
@@ -233,26 +575,39 @@ class TCP_Recreate:
 
         return ethhdr + iphdr + tcphdr + str(payload)
 
-    def write_pkt(self, timestamp, cli, payload, flags=0):
+    def frame(self, timestamp, cli, payload, flags=0):
         p = self.packet(cli, payload, flags)
-        frame = (timestamp + (len(p),), p)
-        self.pcap.write(frame)
         self.lastts = timestamp
+        return (timestamp + (len(p),), p)
+
+    def write_pkt(self, timestamp, cli, payload, flags=0):
+        self.pcap.write(self.frame(timestamp, cli, payload, flags))
+
+    def write_frames(self, frames):
+        try:
+            write_batch = self.pcap.write_batch
+        except AttributeError:
+            for frame in frames:
+                self.pcap.write(frame)
+        else:
+            write_batch(frames)
 
     def write(self, timestamp, cli, data):
+        frames = []
         while data:
             d, data = data[:0xff00], data[0xff00:]
-            self.write_pkt(timestamp, cli, d, ACK)
+            frames.append(self.frame(timestamp, cli, d, ACK))
+        self.write_frames(frames)
 
     def handshake(self, timestamp):
-        self.write_pkt(timestamp, True, '', SYN)
-        self.write_pkt(timestamp, False, '', SYN|ACK)
+        self.write_frames([self.frame(timestamp, True, '', SYN),
+                           self.frame(timestamp, False, '', SYN|ACK)])
         #self.write_pkt(timestamp, True, '', ACK)
 
     def close(self):
-        self.write_pkt(self.lastts, True, '', FIN|ACK)
-        self.write_pkt(self.lastts, False, '', FIN|ACK)
-        self.write_pkt(self.lastts, True, '', ACK)
+        self.write_frames([self.frame(self.lastts, True, '', FIN|ACK),
+                           self.frame(self.lastts, False, '', FIN|ACK),
+                           self.frame(self.lastts, True, '', ACK)])
 
     def __del__(self):
         if not self.closed:
@@ -264,7 +619,17 @@ RST = 4
 PSH = 8
 ACK = 16
 
-class TCP_Resequence:
+def seq_unwrap(seq, near):
+    """Turn 32-bit sequence number seq into the one closest to near.
+
+    Sequence numbers kept this way keep counting up past 2**32, so
+    plain comparisons and subtraction work across a wrap.
+
+    """
+
+    return near + ((seq - near + 0x80000000) & 0xffffffff) - 0x80000000
+
+class TCP_Resequence(object):
     """TCP session resequencer.
 
     >>> p = pcap.open('whatever.pcap')
@@ -284,48 +649,133 @@ class TCP_Resequence:
     Doesn't (yet) handle fragments or dropped packets.  Does handle out
     of order packets.
 
+    pending maps sequence number to frame, in each direction, and order
+    keeps those sequence numbers sorted, so each ACK only has to look at
+    the frames it covers.  Both are None until something is pending, and
+    again once the session is closed and nothing is, since most sessions
+    in a big table are finished ones.
+
+    Sequence numbers in pending, order and lastack are unwrapped with
+    seq_unwrap(), so they can go past 2**32.
+
+    queued holds how many payload octets are pending in each direction;
+    pending_bytes is their sum.  trim() forces out the oldest of them
+    when that gets too big.
+
+    pack() turns a session with nothing pending into three numbers, and
+    unpack() turns them back into a session, so FlowTable can keep it in
+    arrays.  first doesn't survive that.
+
     """
 
+    __slots__ = ('cli', 'srv', 'lastack', 'first', 'pending', 'order',
+                 'queued', 'closed', 'midstream', 'hash', 'handle')
+
+    # Values of handle, by their number in pack()
+    _states = ('handle_handshake', 'handle_packet', 'handle_drop')
+
     def __init__(self):
         self.cli = None
         self.srv = None
         self.lastack = [None, None]
         self.first = None
-        self.pending = [{}, {}]
+        self.pending = None
+        self.order = None
+        self.queued = [0, 0]
         self.closed = [False, False]
         self.midstream = False
         self.hash = 0
 
+        # The current value of self.handle is the state
         self.handle = self.handle_handshake
 
 
-    def bundle_pending(self, xdi, pkt, seq):
+    @property
+    def pending_bytes(self):
+        return self.queued[0] + self.queued[1]
+
+    def pack(self, flow):
+        """Return (flags, lastack[0], lastack[1]) for this session, or None.
+
+        flow is the session's flow key, which holds its endpoints.  Only
+        sessions with nothing pending, that have seen a frame, can be
+        packed.
+
+        """
+
+        if ((self.cli is None) or any(self.queued) or
+            (self.pending and (self.pending[0] or self.pending[1]))):
+            return None
+        try:
+            flags = self._states.index(self.handle.__name__)
+        except ValueError:
+            return None
+        flags |= (self.closed[0] << 2) | (self.closed[1] << 3) | (self.midstream << 4)
+        if (((self.srv[0] & 0xffffffff) << 16) | self.srv[1]) == flow >> 56:
+            # The server is the lower end
+            flags |= 0x20
+        acks = [0, 0]
+        for i in (0, 1):
+            if self.lastack[i] is None:
+                flags |= 0x40 << i
+            else:
+                acks[i] = self.lastack[i]
+        return (flags, acks[0], acks[1])
+
+    @classmethod
+    def unpack(cls, flow, flags, ack0, ack1):
+        """Return a session from what pack() returned for it"""
+
+        self = cls.__new__(cls)
+        (a, b) = flow_endpoints(flow)
+        if flags & 0x20:
+            (self.cli, self.srv) = (b, a)
+        else:
+            (self.cli, self.srv) = (a, b)
+        self.hash = a[0] ^ a[1] ^ b[0] ^ b[1]
+        self.lastack = [None if flags & 0x40 else ack0,
+                        None if flags & 0x80 else ack1]
+        self.first = self.pending = self.order = None
+        self.queued = [0, 0]
+        self.closed = [bool(flags & 4), bool(flags & 8)]
+        self.midstream = bool(flags & 0x10)
+        self.handle = getattr(self, self._states[flags & 3])
+        return self
+
+    def bundle_pending(self, xdi, pkt, seq, ack=None):
         """Bundle up any pending packets.
 
         Called when a packet comes from a new direction, this is the thing responsible for
         replaying TCP as a back-and-forth conversation.
 
+        Everything from seq up to ack (pkt.ack, unless given) is bundled.
+
         """
 
-        pending = self.pending[xdi]
-        # Get a sorted list of sequence numbers
-        keys = pending.keys()
-        keys.sort()
+        if ack is None:
+            ack = pkt.ack
+        if self.pending:
+            pending = self.pending[xdi]
+            order = self.order[xdi]
+        else:
+            pending = {}
+            order = []
+        # Everything before ack comes out; the rest is in the future
+        n = bisect.bisect_left(order, ack)
 
         # Build up return value
         gs = gapstr.GapString()
-        if keys:
-            f = pending[keys[0]]
+        if order:
+            f = pending[order[0]]
             ret = (xdi, f, gs)
         else:
             ret = (xdi, None, gs)
 
         # Fill in gs with our frames
-        for key in keys:
-            if key >= pkt.ack:
-                # In the future
-                break
-            frame = pending[key]
+        for key in order[:n]:
+            frame = pending.pop(key)
+            payload = frame.payload
+            self.queued[xdi] -= len(payload)
             if key > seq:
                 # Dropped frame(s)
                 if key - seq > 6000:
@@ -334,38 +784,92 @@ class TCP_Resequence:
                 seq = key
             if key == seq:
                 # Default
-                gs.append(frame.payload)
-                seq += len(frame.payload)
-                del pending[key]
-            elif key < seq:
-                # Hopefully just a retransmit.  Anyway we've already
-                # claimed to have data (or a drop) for this packet.
-                del pending[key]
+                gs.append(payload)
+                seq += len(payload)
+            elif key + len(payload) > seq:
+                # Retransmit with more on the end.  We've already
+                # claimed to have data (or a drop) for the front of it.
+                gs.append(payload[seq - key:])
+                seq = key + len(payload)
+            # Otherwise it's just a retransmit
             if frame.flags & (FIN):
                 seq += 1
             if frame.flags & (FIN | ACK) == FIN | ACK:
                 self.closed[xdi] = True
                 if self.closed == [True, True]:
                     self.handle = self.handle_drop
-        if seq != pkt.ack:
+        if seq < ack:
             # Drop at the end
-            if pkt.ack - seq > 6000:
+            if ack - seq > 6000:
                 print 'Large drop at end of session!'
-                print '    %s' % ((pkt, pkt.time),)
-                print '    %x  %x' % (pkt.ack, seq)
-            gs.append(pkt.ack - seq)
+                print '    %s' % ((pkt, pkt and pkt.time),)
+                print '    %x  %x' % (ack, seq)
+            gs.append(ack - seq)
+        del order[:n]
+        if (self.handle == self.handle_drop) and not any(self.queued):
+            # Nothing left but bare ACKs, which there's no more use for
+            self.pending = self.order = None
 
         return ret
 
+    def flush(self):
+        """Bundle up everything still pending, in both directions.
 
-    def handle(self, pkt):
-        """Stub.
+        For sessions that are being given up on before they finish.
+        Returns a list of (xdi, frame, GapString), like handle() does.
 
-        This function will never be called, it is immediately overridden
-        by __init__.  The current value of self.handle is the state.
         """
 
-        raise NotImplementedError()
+        ret = []
+        if not self.pending:
+            return ret
+        for xdi in (0, 1):
+            pending = self.pending[xdi]
+            if not pending:
+                continue
+            idx = 1 - xdi
+            seq = self.lastack[idx]
+            if seq is None:
+                seq = self.order[xdi][0]
+            ack = max(key + len(frame.payload) for (key, frame) in pending.iteritems())
+            if ack > seq:
+                ret.append(self.bundle_pending(xdi, None, seq, ack))
+                self.lastack[idx] = ack
+        return ret
+
+    def trim(self, budget):
+        """Bundle up the oldest pending data until at most budget octets are left.
+
+        Whatever hasn't been seen yet before that data comes out as
+        gaps.  Returns a list of (xdi, frame, GapString), like flush().
+
+        """
+
+        ret = []
+        if not self.pending:
+            return ret
+        for xdi in sorted((0, 1), key=lambda d: -self.queued[d]):
+            excess = self.pending_bytes - budget
+            if excess <= 0:
+                break
+            pending = self.pending[xdi]
+            if not pending:
+                continue
+            idx = 1 - xdi
+            seq = self.lastack[idx]
+            if seq is None:
+                seq = self.order[xdi][0]
+            ack = seq
+            for key in self.order[xdi]:
+                if excess <= 0:
+                    break
+                n = len(pending[key].payload)
+                ack = max(ack, key + n)
+                excess -= n
+            if ack > seq:
+                ret.append(self.bundle_pending(xdi, None, seq, ack))
+                self.lastack[idx] = ack
+        return ret
 
 
     def handle_handshake(self, pkt):
@@ -401,21 +905,39 @@ class TCP_Resequence:
         idx = int(pkt.src == self.srv)
         xdi = 1 - idx
 
+        # Where this ACKs up to, in unwrapped sequence numbers
+        seq = self.lastack[idx]
+        if pkt.flags & ACK:
+            ack = seq_unwrap(pkt.ack, seq)
+        else:
+            ack = seq
+
         if pkt.flags & RST:
             # Handle RST before wonky sequence numbers screw up algorithm
             self.closed = [True, True]
             self.handle = self.handle_drop
 
-            return self.bundle_pending(xdi, pkt, self.lastack[idx])
+            return self.bundle_pending(xdi, pkt, seq, ack)
         else:
             # Stick it into pending
-            self.pending[idx][pkt.seq] = pkt
+            if not self.pending:
+                self.pending = ({}, {})
+                self.order = ([], [])
+            pending = self.pending[idx]
+            key = seq_unwrap(pkt.seq, self.lastack[xdi])
+            old = pending.get(key)
+            if old:
+                self.queued[idx] -= len(old.payload)
+            else:
+                bisect.insort(self.order[idx], key)
+            pending[key] = pkt
+            self.queued[idx] += len(pkt.payload)
 
             # Does this ACK after the last output sequence number?
-            seq = self.lastack[idx]
-            self.lastack[idx] = pkt.ack
-            if pkt.ack > seq:
-                return self.bundle_pending(xdi, pkt, seq)
+            # (It may not, if trim() has already pushed it past.)
+            if ack > seq:
+                self.lastack[idx] = ack
+                return self.bundle_pending(xdi, pkt, seq, ack)
 
 
     def handle_drop(self, pkt):
@@ -431,12 +953,388 @@ class TCP_Resequence:
             hexdump(pkt.payload)
 
 
+# States of FlowTable slots
+(_EMPTY, _GONE, _KEPT, _PACKED) = range(4)
+
+class FlowTable(object):
+    """Per-flow state, keyed by flow key.
+
+    Works like a dict.  Keys are kept in an open-addressed table made
+    of arrays, and values of class Value that pack() are kept in arrays
+    too, so a flow with nothing pending costs tens of octets instead of
+    a dict entry and an object.  Anything else is kept as it is.
+
+    A packed value is unpacked into a new object when it's looked up,
+    and packed again after some other flows have been looked up, so
+    look values up again instead of holding on to them.
+
+    touch() records when a flow was last seen, in capture time, and
+    expire() uses that to throw out idle and least recently used flows.
+    created, expired and evicted count flows added, thrown out for
+    being idle, and thrown out for lack of room.
+
+    """
+
+    # Class of values to pack
+    Value = TCP_Resequence
+
+    # Slots to start with; there are twice as many once two thirds are used
+    size = 1024
+
+    # Pack values handed out once this many flows have been looked up
+    loose = 1024
+
+    __slots__ = ('_mask', '_len', '_used', '_state', '_khi', '_klo',
+                 '_flags', '_ack0', '_ack1', '_seen', '_objs',
+                 '_queue', '_qtime', '_qhead', '_loose',
+                 '_hkey', '_hval',
+                 'created', 'expired', 'evicted')
+
+    def __init__(self):
+        self._alloc(self.size)
+        self._len = 0
+        # The last key hashed, and its hash
+        self._hkey = None
+        self._hval = 0
+        self.created = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def _alloc(self, size):
+        self._mask = size - 1
+        self._used = 0
+        self._state = array.array('B', [_EMPTY]) * size
+        self._khi = array.array(_INT64, [0]) * size
+        self._klo = array.array(_INT64, [0]) * size
+        self._flags = array.array('B', [0]) * size
+        self._ack0 = array.array(_SINT64, [0]) * size
+        self._ack1 = array.array(_SINT64, [0]) * size
+        self._seen = array.array('d', [-1.0]) * size
+        # Unpacked values, by slot
+        self._objs = {}
+        # Slots, and when they were touched, oldest first, from _qhead
+        # on.  Entries are left behind when a flow is touched again, and
+        # skipped when they come up.
+        self._queue = array.array(_INT64)
+        self._qtime = array.array('d')
+        self._qhead = 0
+        # Slots of values handed out, by key, to pack later
+        self._loose = {}
+
+    def _slot(self, key):
+        """Return key's slot, or -1"""
+
+        # Most often one just looked up
+        i = self._loose.get(key)
+        if i is not None:
+            return i
+        lo = key & 0xffffffffffffffff
+        state = self._state
+        klo = self._klo
+        mask = self._mask
+        if key == self._hkey:
+            h = self._hval
+        else:
+            h = self._hval = _flow_mix(key)
+            self._hkey = key
+        i = h & mask
+        # Double hashing: deleted slots are left behind, and linear
+        # probing makes long runs of them
+        step = (h >> 40) | 1
+        while True:
+            s = state[i]
+            if s == _EMPTY:
+                return -1
+            if (s != _GONE) and (klo[i] == lo) and (self._khi[i] == key >> 64):
+                return i
+            i = (i + step) & mask
+
+    def _key(self, i):
+        return (self._khi[i] << 64) | self._klo[i]
+
+    def _insert(self, key):
+        """Return a new slot for key, which isn't in the table"""
+
+        if (self._used + 1) * 3 > (self._mask + 1) * 2:
+            self._resize()
+        state = self._state
+        mask = self._mask
+        if key == self._hkey:
+            h = self._hval
+        else:
+            h = self._hval = _flow_mix(key)
+            self._hkey = key
+        i = h & mask
+        step = (h >> 40) | 1
+        while state[i] > _GONE:
+            i = (i + step) & mask
+        if state[i] == _EMPTY:
+            self._used += 1
+        state[i] = _KEPT
+        self._khi[i] = key >> 64
+        self._klo[i] = key & 0xffffffffffffffff
+        self._seen[i] = -1.0
+        self._len += 1
+        return i
+
+    def _resize(self):
+        """Move everything into a new set of arrays, big enough to grow"""
+
+        self._settle()
+        old = (self._state, self._khi, self._klo, self._flags,
+               self._ack0, self._ack1, self._seen, self._objs,
+               self._queue[self._qhead:], self._qtime[self._qhead:])
+        size = self._mask + 1
+        if self._len * 3 > size:
+            size *= 2
+        self._alloc(size)
+        (state, khi, klo, flags, ack0, ack1, seen, objs, queue, qtime) = old
+        moved = {}
+        n = self._len
+        self._len = 0
+        for j in xrange(len(state)):
+            if state[j] > _GONE:
+                i = moved[j] = self._insert((khi[j] << 64) | klo[j])
+                self._state[i] = state[j]
+                self._flags[i] = flags[j]
+                self._ack0[i] = ack0[j]
+                self._ack1[i] = ack1[j]
+                self._seen[i] = seen[j]
+                if j in objs:
+                    self._objs[i] = objs[j]
+        assert self._len == n
+        # The touch queue keeps its order, less what's out of date
+        for n in xrange(len(queue)):
+            j = queue[n]
+            if (state[j] > _GONE) and (seen[j] == qtime[n]):
+                self._queue.append(moved[j])
+                self._qtime.append(qtime[n])
+
+    def _requeue(self):
+        """Rebuild the touch queue from when each flow was last seen"""
+
+        seen = self._seen
+        state = self._state
+        touched = sorted((seen[i], self._key(i), i) for i in xrange(len(state))
+                         if (state[i] > _GONE) and (seen[i] >= 0))
+        self._queue = array.array(_INT64, [i for (t, key, i) in touched])
+        self._qtime = array.array('d', [t for (t, key, i) in touched])
+        self._qhead = 0
+
+    def _pack(self, i):
+        """Pack the value in slot i, if it can be"""
+
+        if self._state[i] != _KEPT:
+            return
+        value = self._objs[i]
+        if type(value) is not self.Value:
+            return
+        packed = value.pack(self._key(i))
+        if packed:
+            (self._flags[i], self._ack0[i], self._ack1[i]) = packed
+            self._state[i] = _PACKED
+            del self._objs[i]
+
+    def _settle(self):
+        """Pack the values handed out"""
+
+        for i in self._loose.itervalues():
+            self._pack(i)
+        self._loose = {}
+
+    def _hold(self, key, i):
+        """Note that the value in slot i, for key, is being handed out"""
+
+        loose = self._loose
+        if key not in loose:
+            if len(loose) >= self.loose:
+                self._settle()
+                loose = self._loose
+            loose[key] = i
+
+    def _value(self, i):
+        if self._state[i] == _PACKED:
+            return self.Value.unpack(self._key(i), self._flags[i],
+                                     self._ack0[i], self._ack1[i])
+        return self._objs[i]
+
+    def _hand_out(self, key, i):
+        """Return the value in slot i, unpacked and kept unpacked for now"""
+
+        self._hold(key, i)
+        if self._state[i] == _PACKED:
+            self._objs[i] = self._value(i)
+            self._state[i] = _KEPT
+        return self._objs[i]
+
+    def _remove(self, key, i):
+        """Empty slot i, for key, returning its value"""
+
+        value = self._value(i)
+        self._state[i] = _GONE
+        self._objs.pop(i, None)
+        self._len -= 1
+        self._loose.pop(key, None)
+        return value
+
+    def __len__(self):
+        return self._len
+
+    def __contains__(self, key):
+        return self._slot(key) >= 0
+
+    def __iter__(self):
+        state = self._state
+        for i in xrange(len(state)):
+            if state[i] > _GONE:
+                yield self._key(i)
+
+    def __getitem__(self, key):
+        i = self._slot(key)
+        if i < 0:
+            raise KeyError(key)
+        return self._hand_out(key, i)
+
+    def __setitem__(self, key, value):
+        i = self._slot(key)
+        if i < 0:
+            i = self._insert(key)
+            self.created += 1
+        self._hold(key, i)
+        self._state[i] = _KEPT
+        self._objs[i] = value
+
+    def __delitem__(self, key):
+        i = self._slot(key)
+        if i < 0:
+            raise KeyError(key)
+        self._remove(key, i)
+
+    def get(self, key, default=None):
+        i = self._slot(key)
+        if i < 0:
+            return default
+        return self._hand_out(key, i)
+
+    def pop(self, key, *default):
+        i = self._slot(key)
+        if i < 0:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        return self._remove(key, i)
+
+    def touch(self, key, now):
+        """Note that flow key was seen at time now"""
+
+        i = self._slot(key)
+        if i < 0:
+            raise KeyError(key)
+        self._seen[i] = now
+        self._queue.append(i)
+        self._qtime.append(now)
+        if len(self._queue) - self._qhead > 2 * self._len + 1024:
+            self._requeue()
+
+    def _live(self, n):
+        """Return the slot of queue entry n, if it's still current, or -1"""
+
+        i = self._queue[n]
+        if (self._state[i] > _GONE) and (self._seen[i] == self._qtime[n]):
+            return i
+        return -1
+
+    def expire(self, now, idle=None, maximum=None):
+        """Remove flows that have been idle for more than idle seconds.
+
+        Then, if there are more than maximum flows left, remove the
+        least recently seen ones.  Returns a list of (key, value) for
+        each flow removed.
+
+        """
+
+        ret = []
+        n = self._qhead
+        while n < len(self._queue):
+            i = self._live(n)
+            if i < 0:
+                # Touched since, or gone
+                n += 1
+                continue
+            if (idle is not None) and (self._qtime[n] < now - idle):
+                self.expired += 1
+            elif (maximum is not None) and (self._len > maximum):
+                self.evicted += 1
+            else:
+                break
+            n += 1
+            key = self._key(i)
+            ret.append((key, self._remove(key, i)))
+        self._qhead = n
+        if n > len(self._queue) // 2 + 1024:
+            del self._queue[:n]
+            del self._qtime[:n]
+            self._qhead = 0
+        return ret
+
+    def oldest(self):
+        """Generate keys of flows, least recently seen first"""
+
+        queue = self._queue[self._qhead:]
+        qtime = self._qtime[self._qhead:]
+        seen = self._seen
+        for n in xrange(len(queue)):
+            i = queue[n]
+            if (self._state[i] > _GONE) and (seen[i] == qtime[n]):
+                yield self._key(i)
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        return [(key, self[key]) for key in self]
+
+    def values(self):
+        return [self[key] for key in self]
+
+
 class Dispatch:
+    # Set to True to memory-map capture files instead of reading them
+    mapped = False
+
+    # Frame class to decode packets with
+    Frame = LazyFrame
+
+    # Give up on TCP sessions not seen for this many seconds of capture time
+    idle_timeout = None
+
+    # Give up on the least recently seen TCP sessions beyond this many
+    max_sessions = None
+
+    # Force out the oldest unacknowledged data of a TCP session holding
+    # more than this many payload octets
+    max_session_pending = None
+
+    # Force out the unacknowledged data of the least recently seen TCP
+    # sessions while they all hold more than this many payload octets,
+    # down to three quarters of it so it doesn't happen every packet
+    max_pending = None
+
+    # Set to False if the capture files don't overlap in time.  Each one
+    # is then read straight through, in order of their first packets.
+    overlap = True
+
     def __init__(self, *filenames):
         self.pcs = {}
 
-        self.sessions = {}
+        self.sessions = FlowTable()
+        # Heap of (ts_sec, ts_usec, file number, record number, offset,
+        # record, source, filename): the next record from each file
         self.tops = []
+        self.opened = 0
+
+        # Payload octets pending across all TCP sessions
+        self.pending_bytes = 0
 
         self.last = None
 
@@ -444,43 +1342,584 @@ class Dispatch:
             self.open(fn)
 
     def open(self, filename, literal=False):
+        pos = None
         if not literal:
             parts = filename.split(':::')
-            fn = parts[0]
-            fd = file(fn)
-            pc = pcap.open(fd)
+            filename = parts[0]
             if len(parts) > 1:
                 pos = int(parts[1])
-                fd.seek(pos)
-            self._read(pc, fn, fd)
-        else:
-            fd = file(filename)
-            pc = pcap.open(fd)
-            self._read(pc, filename, fd)
+        pc = pcap.open_offline(filename, mapped=self.mapped)
+        if pos is not None:
+            pc.seek(pos)
+        self._read(scan_records(pc), filename)
 
-    def _read(self, pc, filename, fd):
-        pos = fd.tell()
-        f = pc.read()
-        if f:
-            heapq.heappush(self.tops, (f, pc, filename, fd, pos))
+    def open_window(self, filename, start, end):
+        """Open only the packets in filename captured in [start, end).
+
+        Times are in seconds since the epoch.  Uses the index next to
+        the capture, building one first if it isn't there.
+
+        """
+
+        idx = load_index(filename)
+        (first, last) = idx.window(start, end)
+        if last <= first:
+            return
+        start = int(start * 1000000)
+        end = int(end * 1000000)
+        pc = pcap.open_offline(filename, mapped=self.mapped)
+        pc.seek(idx.offsets[first])
+        src = ((pos, f) for (pos, f) in scan_records(pc, last - first)
+               if start <= f[0][0] * 1000000 + f[0][1] < end)
+        self._read(src, filename)
+
+    def open_session(self, filename, flow):
+        """Open only the packets in filename with this flow key"""
+
+        idx = load_index(filename)
+        pc = pcap.open_offline(filename, mapped=self.mapped)
+        src = ((pos, f) for (pos, f) in pick_records(pc, idx.flow(flow))
+               if self.Frame(f).flow == flow)
+        self._read(src, filename)
+
+    def _trim(self, sess, budget):
+        queued = sess.pending_bytes
+        ret = sess.trim(budget)
+        self.pending_bytes += sess.pending_bytes - queued
+        return ret
+
+    def _read(self, src, filename):
+        for (pos, f) in src:
+            ((tv_sec, tv_usec, _), _) = f
+            heapq.heappush(self.tops, (tv_sec, tv_usec, self.opened, 0, pos, f, src, filename))
+            break
+        self.opened += 1
+
+    def _records(self):
+        """Generate (f, filename, pos) for every record, in capture order"""
+
+        tops = self.tops
+        while tops:
+            (_, _, fileno, recno, pos, f, src, filename) = tops[0]
+            if not self.overlap:
+                heapq.heappop(tops)
+                yield f, filename, pos
+                for (pos, f) in src:
+                    yield f, filename, pos
+                continue
+            nxt = next(src, None)
+            if nxt:
+                (npos, nf) = nxt
+                ((tv_sec, tv_usec, _), _) = nf
+                heapq.heapreplace(tops, (tv_sec, tv_usec, fileno, recno + 1, npos, nf, src, filename))
+            else:
+                heapq.heappop(tops)
+            yield f, filename, pos
+
+    def handle(self, frame):
+        """Handle one frame, generating (flow key, (xdi, frame, GapString))"""
+
+        if frame.protocol != TCP:
+            return
+        flow = frame.flow
+        tcp_sess = self.sessions.get(flow)
+        if not tcp_sess:
+            tcp_sess = TCP_Resequence()
+            self.sessions[flow] = tcp_sess
+        if ((self.idle_timeout is not None) or (self.max_sessions is not None) or
+            (self.max_pending is not None)):
+            # Only these need to know which sessions were seen last
+            self.sessions.touch(flow, frame.time)
+        queued = tcp_sess.pending_bytes
+        ret = tcp_sess.handle(frame)
+        self.pending_bytes += tcp_sess.pending_bytes - queued
+        if ret:
+            yield flow, ret
+        if ((self.max_session_pending is not None) and
+            (tcp_sess.pending_bytes > self.max_session_pending)):
+            for ret in self._trim(tcp_sess, self.max_session_pending):
+                yield flow, ret
+        if (self.idle_timeout is not None) or (self.max_sessions is not None):
+            for (key, sess) in self.sessions.expire(frame.time,
+                                                    self.idle_timeout,
+                                                    self.max_sessions):
+                self.pending_bytes -= sess.pending_bytes
+                for ret in sess.flush():
+                    yield key, ret
+        if (self.max_pending is not None) and (self.pending_bytes > self.max_pending):
+            low = self.max_pending * 3 // 4
+            for key in self.sessions.oldest():
+                sess = self.sessions[key]
+                for ret in self._trim(sess, 0):
+                    yield key, ret
+                if self.pending_bytes <= low:
+                    break
 
     def __iter__(self):
-        while self.tops:
-            f, pc, filename, fd, pos = heapq.heappop(self.tops)
+        """Generate (flow key, (xdi, frame, GapString)) for each chunk.
+
+        The key is frame.flow.  It used to be frame.hash, which frames
+        still have, but which two different flows can share.
+
+        """
+
+        for (f, filename, pos) in self._records():
             if not self.last:
                 self.last = (filename, pos)
-            frame = Frame(f)
-            if frame.protocol == TCP:
-                # compute TCP session hash
-                tcp_sess = self.sessions.get(frame.hash)
-                if not tcp_sess:
-                    tcp_sess = TCP_Resequence()
-                    self.sessions[frame.hash] = tcp_sess
-                ret = tcp_sess.handle(frame)
-                if ret:
-                    yield frame.hash, ret
-                    self.last = None
-            self._read(pc, filename, fd)
+            for ret in self.handle(self.Frame(f)):
+                yield ret
+                self.last = None
+
+
+# ordinal, ts_sec, ts_usec, length, caplen
+_SHARDREC = struct.Struct('=qIIII')
+
+class _Shard:
+    """A ParallelDispatch worker process, from the reader's end.
+
+    Frames are packed into a ring of shared memory slots; only slot
+    numbers go through the queues.  sent is the ordinal of the last
+    frame handed to the worker, done the last one it has finished.
+
+    """
+
+    def __init__(self, dispatch, w, results):
+        self.w = w
+        self.poll = dispatch.poll
+        self.size = dispatch.slot_size
+        self.mm = mmap.mmap(-1, dispatch.slots * self.size)
+        self.todo = multiprocessing.Queue()
+        self.free = multiprocessing.Queue()
+        for slot in range(dispatch.slots):
+            self.free.put(slot)
+        self.slot = None
+        self.start = self.pos = self.end = 0
+        self.sent = self.done = -1
+        self.finished = False
+        self.proc = multiprocessing.Process(target=dispatch._work,
+                                            args=(w, self.mm, self.todo, self.free, results))
+        self.proc.daemon = True
+        self.proc.start()
+
+    def put(self, ordinal, f):
+        """Add a frame; returns True if a full slot went to the worker"""
+
+        ((tv_sec, tv_usec, length), data) = f
+        n = _SHARDREC.size + len(data)
+        sent = False
+        if (self.slot is not None) and (self.pos + n > self.end):
+            sent = self.send()
+        if self.slot is None:
+            if n > self.size:
+                raise IOError('Frame too big for a slot')
+            self.slot = self.get(self.free)
+            self.start = self.pos = self.slot * self.size
+            self.end = self.start + self.size
+        _SHARDREC.pack_into(self.mm, self.pos, ordinal, tv_sec, tv_usec, length, len(data))
+        self.pos += _SHARDREC.size
+        self.mm[self.pos:self.pos + len(data)] = str(data)
+        self.pos += len(data)
+        self.sent = ordinal
+        return sent
+
+    def get(self, queue):
+        """Get from queue, raising RuntimeError if the worker dies first"""
+
+        while True:
+            try:
+                return queue.get(True, self.poll)
+            except Queue.Empty:
+                pass
+            if not self.proc.is_alive():
+                try:
+                    # Anything it put there on its way out
+                    return queue.get_nowait()
+                except Queue.Empty:
+                    raise RuntimeError('Worker %d died with exit code %s' %
+                                       (self.w, self.proc.exitcode))
+
+    def send(self):
+        """Hand the current slot to the worker"""
+
+        if self.slot is None:
+            return False
+        self.todo.put((self.slot, self.pos - self.start))
+        self.slot = None
+        return True
+
+
+class ParallelDispatch(Dispatch):
+    """Dispatch that spreads TCP sessions over worker processes.
+
+    This process reads the capture files and hands each TCP frame,
+    through shared memory, to the worker picked by its flow key.  Each
+    worker keeps its own session table, and sends back what comes out.
+
+    With ordered set, results come out in the order of the frames that
+    caused them, like Dispatch.  Otherwise they come out as soon as
+    the workers have them.
+
+    Session limits and pending data budgets apply to each worker on its
+    own.
+
+    """
+
+    # How many worker processes
+    workers = multiprocessing.cpu_count()
+
+    # Put results back in capture order
+    ordered = True
+
+    # If set, workers feed results to one of these for each TCP session,
+    # instead of sending them back, and call done() on them at the end
+    Session = None
+
+    # Shared memory for each worker: this many slots of slot_size octets
+    slots = 4
+    slot_size = 1 << 20
+
+    # Hand partly filled slots to workers after this many frames
+    flush_every = 4096
+
+    # Seconds between checks that workers are still alive, while waiting
+    # on them
+    poll = 1.0
+
+    def _work(self, w, mm, todo, free, results):
+        self.sessions = FlowTable()
+        self.pending_bytes = 0
+        sessions = {}
+        err = None
+        try:
+            for (slot, n) in iter(todo.get, None):
+                pos = slot * self.slot_size
+                end = pos + n
+                out = []
+                while pos < end:
+                    (ordinal, tv_sec, tv_usec, length, caplen) = _SHARDREC.unpack_from(mm, pos)
+                    pos += _SHARDREC.size
+                    frame = self.Frame(((tv_sec, tv_usec, length), mm[pos:pos + caplen]))
+                    pos += caplen
+                    for (key, ret) in self.handle(frame):
+                        if self.Session:
+                            self._session(sessions, key, ret)
+                        else:
+                            out.append((ordinal, key, ret))
+                free.put(slot)
+                results.put((w, ordinal, out))
+            for sess in sessions.itervalues():
+                sess.done()
+        except Exception:
+            err = traceback.format_exc()
+        results.put((w, None, err))
+
+    def _session(self, sessions, key, ret):
+        (xdi, frame, gs) = ret
+        sess = sessions.get(key)
+        if not sess:
+            if not frame:
+                return
+            sess = sessions[key] = self.Session(frame)
+        sess.handle(xdi, frame, gs, None)
+
+    def _result(self, shards, results):
+        """Wait for the next result, raising RuntimeError if a worker dies"""
+
+        while True:
+            try:
+                return results.get(True, self.poll)
+            except Queue.Empty:
+                pass
+            for s in shards:
+                if not (s.finished or s.proc.is_alive()):
+                    try:
+                        return results.get_nowait()
+                    except Queue.Empty:
+                        raise RuntimeError('Worker %d died with exit code %s' %
+                                           (s.w, s.proc.exitcode))
+
+    def _mark(self, where, ordinal):
+        """Set last for a result from frame ordinal, like Dispatch does.
+
+        where holds (ordinal, (filename, offset)) of each frame
+        handed out and not yet yielded from, so its head is the first
+        frame since the last result.  Only exact with ordered set, and
+        empty with Session set.
+
+        """
+
+        if where and (where[0][0] <= ordinal):
+            self.last = where[0][1]
+            while where and (where[0][0] <= ordinal):
+                where.popleft()
+        else:
+            # More from the same frame
+            self.last = None
+
+    def _collect(self, shards, results, heap, where, block):
+        while True:
+            if block:
+                if not [s for s in shards if not s.finished]:
+                    break
+                (w, ordinal, out) = self._result(shards, results)
+            else:
+                try:
+                    (w, ordinal, out) = results.get_nowait()
+                except Queue.Empty:
+                    break
+            shard = shards[w]
+            if ordinal is None:
+                if out:
+                    raise RuntimeError('Worker %d failed:\n%s' % (w, out))
+                shard.finished = True
+                shard.done = shard.sent
+                continue
+            shard.done = ordinal
+            if not self.ordered:
+                for (o, key, ret) in out:
+                    self._mark(where, o)
+                    yield key, ret
+                continue
+            for (i, (o, key, ret)) in enumerate(out):
+                heapq.heappush(heap, (o, i, key, ret))
+            # Nothing can come in below what busy workers have finished
+            busy = [s.done for s in shards if s.done < s.sent]
+            while heap and ((not busy) or (heap[0][0] <= min(busy))):
+                (o, i, key, ret) = heapq.heappop(heap)
+                self._mark(where, o)
+                yield key, ret
+        while block and heap:
+            # Everyone's finished
+            (o, i, key, ret) = heapq.heappop(heap)
+            self._mark(where, o)
+            yield key, ret
+
+    def __iter__(self):
+        results = multiprocessing.Queue()
+        shards = [_Shard(self, w, results) for w in range(self.workers)]
+        heap = []
+        where = collections.deque()
+        try:
+            ordinal = 0
+            for (f, filename, pos) in self._records():
+                frame = self.Frame(f)
+                if frame.protocol != TCP:
+                    continue
+                ordinal += 1
+                # With Session set nothing comes back, so last isn't kept
+                if not self.Session:
+                    where.append((ordinal, (filename, pos)))
+                    if not self.last:
+                        self.last = where[0][1]
+                sent = shards[flow_shard(frame.flow, len(shards))].put(ordinal, f)
+                if ordinal % self.flush_every == 0:
+                    for s in shards:
+                        s.send()
+                    sent = True
+                if sent:
+                    for ret in self._collect(shards, results, heap, where, False):
+                        yield ret
+            for s in shards:
+                s.send()
+                s.todo.put(None)
+            for ret in self._collect(shards, results, heap, where, True):
+                yield ret
+            self.last = None
+        finally:
+            for s in shards:
+                if s.proc.is_alive():
+                    s.proc.terminate()
+                s.proc.join()
+
+
+def scan_records(pc, count=-1, n=256):
+    """Generate (offset, record) from pc, for count records if given.
+
+    Records are read n at a time with read_batch, except from pcapng
+    files, where batches don't know where their records came from.
+    Unless pc is mapped, record data are copied out of the batch, so
+    one kept around doesn't keep the whole batch.
+
+    """
+
+    if pc.pcapng:
+        while count:
+            pos = pc.tell()
+            f = pc.read()
+            if not f:
+                break
+            yield (pos, f)
+            count -= 1
+        return
+
+    while count:
+        if count > 0:
+            n = min(n, count)
+        b = pc.read_batch(n, n << 10)
+        if not len(b):
+            break
+        for i in xrange(len(b)):
+            if pc.mapped:
+                yield (b.tell(i), b[i])
+            else:
+                (hdr, data) = b[i]
+                yield (b.tell(i), (hdr, str(data)))
+        count -= len(b)
+
+def pick_records(pc, offsets):
+    """Generate (offset, record) from pc for each record offset"""
+
+    for pos in offsets:
+        pc.seek(pos)
+        f = pc.read()
+        if not f:
+            break
+        yield (pos, f)
+
+
+##
+## Packet offset index
+##
+
+# Array type for unsigned 64-bit values
+_INT64 = 'L'
+if array.array(_INT64).itemsize != 8:
+    _INT64 = 'Q'
+_SINT64 = _INT64.lower()
+
+_INDEX_MAGIC = 'NAIDX\0\0\2'
+
+def _fold(flow):
+    """Fold a flow key into 64 bits"""
+
+    return (flow ^ (flow >> 64)) & 0xffffffffffffffff
+
+class PacketIndex:
+    """Record offsets in a capture, by ordinal, time and flow.
+
+    Packet i starts at offsets[i].  lo[i] is the earliest timestamp at
+    or after packet i, and hi[i] the latest at or before it, so both
+    can be bisected even when the capture isn't quite in time order.
+    Timestamps are in microseconds.  hashes holds each packet's flow
+    key folded to 64 bits, and byhash lists packet ordinals sorted by
+    it.
+
+    """
+
+    def __init__(self):
+        self.offsets = array.array(_INT64)
+        self.lo = array.array(_INT64)
+        self.hi = array.array(_INT64)
+        self.hashes = array.array(_INT64)
+        self.byhash = array.array(_INT64)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def window(self, start, end):
+        """Return the range of ordinals that can hold packets in [start, end)"""
+
+        return (bisect.bisect_left(self.hi, int(start * 1000000)),
+                bisect.bisect_left(self.lo, int(end * 1000000)))
+
+    def flow(self, flow):
+        """Return the offsets of packets that may be in this flow, in order.
+
+        Different flows can fold to the same value, so check the records
+        that come back.
+
+        """
+
+        hash = _fold(flow)
+        hashes = self.hashes
+        byhash = self.byhash
+        a, b = 0, len(byhash)
+        while a < b:
+            mid = (a + b) // 2
+            if hashes[byhash[mid]] < hash:
+                a = mid + 1
+            else:
+                b = mid
+        ret = []
+        while a < len(byhash) and hashes[byhash[a]] == hash:
+            ret.append(self.offsets[byhash[a]])
+            a += 1
+        return ret
+
+    def save(self, fn):
+        fd = file(fn, 'wb')
+        fd.write(struct.pack('<8scQ', _INDEX_MAGIC, sys.byteorder[0], len(self)))
+        for a in (self.offsets, self.lo, self.hi, self.hashes, self.byhash):
+            a.tofile(fd)
+        fd.close()
+
+    def load(self, fn):
+        fd = file(fn, 'rb')
+        (magic, order, count) = struct.unpack('<8scQ', fd.read(17))
+        if magic != _INDEX_MAGIC:
+            raise IOError('Not a packet index')
+        for a in (self.offsets, self.lo, self.hi, self.hashes, self.byhash):
+            a.fromfile(fd, count)
+            if order != sys.byteorder[0]:
+                a.byteswap()
+        fd.close()
+
+
+def build_index(filename, save=True):
+    """Index filename in one pass, saving it next to the capture if it can"""
+
+    idx = PacketIndex()
+    times = array.array(_INT64)
+    pc = pcap.open_offline(filename)
+    for (pos, f) in scan_records(pc):
+        idx.offsets.append(pos)
+        times.append(f[0][0] * 1000000 + f[0][1])
+        try:
+            hash = _fold(LazyFrame(f).flow)
+        except (AttributeError, struct.error):
+            hash = 0
+        idx.hashes.append(hash)
+
+    t = 0
+    for i in xrange(len(times)):
+        t = max(t, times[i])
+        idx.hi.append(t)
+    lo = idx.lo
+    lo.extend(times)
+    del times
+    for i in xrange(len(lo) - 2, -1, -1):
+        if lo[i + 1] < lo[i]:
+            lo[i] = lo[i + 1]
+    if numpy:
+        # Stable, so each flow's packets stay in order
+        byhash = numpy.argsort(numpy.frombuffer(idx.hashes, numpy.uint64), kind='mergesort')
+        idx.byhash.fromstring(byhash.astype(numpy.uint64).tostring())
+    else:
+        idx.byhash.extend(sorted(xrange(len(lo)), key=idx.hashes.__getitem__))
+
+    if save:
+        try:
+            idx.save(filename + '.idx')
+            if isinstance(pc.stream, pcap.zfile):
+                # So another process can seek into the middle of it
+                pc.stream.save_index(filename + '.zidx')
+        except IOError:
+            # Read-only, probably; the index still works from here
+            pass
+    return idx
+
+def load_index(filename):
+    """Load the index for filename, building it if it's missing or stale"""
+
+    fn = filename + '.idx'
+    try:
+        if os.path.getmtime(fn) >= os.path.getmtime(filename):
+            idx = PacketIndex()
+            idx.load(fn)
+            return idx
+    except (OSError, IOError, EOFError, struct.error):
+        pass
+    return build_index(filename)
 
 
 ##
@@ -488,7 +1927,89 @@ class Dispatch:
 ##
 
 class NeedMoreData(Exception):
-    pass
+    """Raised by Packet.parse when data stops short of a whole packet.
+
+    If needed is given, it's how many octets parse needs, counting from
+    the start of the data it was handed.  Session won't call parse again
+    until it has that many.
+
+    """
+
+    def __init__(self, needed=None):
+        Exception.__init__(self, needed)
+        self.needed = needed
+
+##
+## Packet field schemas
+##
+
+class Bytes:
+    """A run of octets in a Packet schema.
+
+    length is a number, the name of an earlier field holding it, or a
+    function taking the packet and returning it.  A Bytes field named
+    payload becomes the packet's payload, and ends the packet.
+
+    """
+
+    def __init__(self, name, length):
+        self.name = name
+        self.length = length
+
+class When:
+    """Fields that are only there if cond(packet) is true"""
+
+    def __init__(self, cond, *fields):
+        self.cond = cond
+        self.fields = fields
+
+# Compiled schemas, by (byte order, fields)
+_schemas = {}
+
+def _compile(fields, byteorder):
+    """Turn a schema into a list of steps.
+
+    Runs of fixed-size fields become one (Struct, [(name, count)])
+    step; Bytes and When fields are steps of their own.
+
+    """
+
+    key = (byteorder, tuple(fields))
+    try:
+        return _schemas[key]
+    except KeyError:
+        pass
+    steps = []
+    fmt = ''
+    names = []
+    for field in tuple(fields) + (None,):
+        if isinstance(field, tuple):
+            (name, code) = field
+            n = len(struct.unpack('=' + code, '\0' * struct.calcsize('=' + code)))
+            fmt += code
+            names.append((name, n))
+            continue
+        if fmt:
+            steps.append((struct.Struct(byteorder + fmt), names))
+            fmt = ''
+            names = []
+        if isinstance(field, When):
+            steps.append((field.cond, _compile(field.fields, byteorder)))
+        elif field:
+            steps.append(field)
+    _schemas[key] = steps
+    return steps
+
+def _flatten(data, n):
+    """Something unpack_from can read the first n octets of data from"""
+
+    contents = getattr(data, 'contents', None)
+    if contents is None:
+        return data
+    if contents and isinstance(contents[0], str) and len(contents[0]) >= n:
+        return contents[0]
+    return str(data[:n])
+
 
 class Packet(UserDict.DictMixin):
     """Base class for a packet from a binary protocol.
@@ -499,6 +2020,24 @@ class Packet(UserDict.DictMixin):
 
     opcodes = {}
 
+    # Schema for the packet header, if parse() should decode it for
+    # you.  Each entry is a (name, struct format) tuple, a Bytes, or a
+    # When.  A name of None skips the value.
+    fields = ()
+
+    # Byte order for fields
+    byteorder = '!'
+
+    # Field giving the opcode, and more fields following the header
+    # for each opcode
+    opcode_field = None
+    opcode_fields = {}
+
+    # Set to True if parse() can pick up where it left off.  After a
+    # NeedMoreData, Session then hands the same packet the same data,
+    # plus whatever has come in since, instead of starting a new one.
+    resumable = False
+
     def __init__(self, session, firstframe=None):
         self.session = session
         self.firstframe = firstframe
@@ -542,6 +2081,12 @@ class Packet(UserDict.DictMixin):
 
     ##
 
+    def need(self, data, n):
+        """Raise NeedMoreData unless data holds at least n octets"""
+
+        if len(data) < n:
+            raise NeedMoreData(n)
+
     def assert_in(self, a, *b):
         if len(b) == 1:
             assert a == b[0], ('%r != %r' % (a, b[0]))
@@ -560,15 +2105,13 @@ class Packet(UserDict.DictMixin):
                                                      time.strftime('%Y-%m-%dT%T', time.gmtime(self.firstframe.time)),
                                                      self.firstframe.time_usec)
 
+        dumps = []
         if self.parts:
             dl = len(self.parts[-1])
-            p = []
-            for x in self.parts[:-1]:
-                if x == dl:
-                    p.append('%3d!' % x)
-                else:
-                    p.append('%3d' % x)
+            p = [self._show_part(x, dl, dumps) for x in self.parts[:-1]]
             print '           parts: (%s) +%d bytes' % (','.join(p), dl)
+        for x in dumps:
+            hexdump(x, sys.stdout)
 
         keys = self.params.keys()
         keys.sort()
@@ -584,6 +2127,20 @@ class Packet(UserDict.DictMixin):
             except AttributeError:
                 print '         payload: %r' % self.payload
 
+    def _show_part(self, x, dl, dumps):
+        """Format one of parts for show(), adding runs of octets to dumps"""
+
+        if isinstance(x, tuple):
+            return '(%s)' % ','.join([self._show_part(y, dl, dumps) for y in x])
+        try:
+            if x == dl:
+                return '%3d!' % x
+            return '%3d' % x
+        except TypeError:
+            # A string field: hex dumped after the parts
+            dumps.append(x)
+            return '<%d bytes>' % len(x)
+
     def parse(self, data):
         """Parse a chunk of data (possibly a GapString).
 
@@ -592,10 +2149,81 @@ class Packet(UserDict.DictMixin):
 
         """
 
+        if self.fields:
+            return self.parse_fields(data)
         self.parts = [data]
         self.payload = data
         return None
 
+    def parse_fields(self, data):
+        """Parse data according to fields and opcode_fields.
+
+        Values go into params and parts, and the opcode field sets
+        opcode.  Without a payload field, everything after the fields
+        is the payload.  With one, anything after it is returned.
+
+        """
+
+        self.parts = []
+        (pos, buf, done) = self._unpack(_compile(self.fields, self.byteorder),
+                                        data, 0, '')
+        if self.opcode_field:
+            self.opcode = self.params[self.opcode_field]
+            fields = self.opcode_fields.get(self.opcode)
+            if fields and not done:
+                (pos, buf, done) = self._unpack(_compile(fields, self.byteorder),
+                                                data, pos, buf)
+        if not done:
+            self.payload = data[pos:]
+        self.parts.append(self.payload)
+        if done:
+            return data[pos:]
+
+    def _unpack(self, steps, data, pos, buf):
+        parts = self.parts
+        params = self.params
+        for step in steps:
+            if isinstance(step, Bytes):
+                length = step.length
+                if isinstance(length, str):
+                    length = params[length]
+                elif callable(length):
+                    length = length(self)
+                end = pos + length
+                self.need(data, end)
+                val = data[pos:end]
+                pos = end
+                if step.name == 'payload':
+                    self.payload = val
+                    return (pos, buf, True)
+                params[step.name] = val
+                parts.append(val)
+            elif isinstance(step[0], struct.Struct):
+                (st, names) = step
+                end = pos + st.size
+                self.need(data, end)
+                if len(buf) < end:
+                    buf = _flatten(data, end)
+                vals = st.unpack_from(buf, pos)
+                pos = end
+                i = 0
+                for (name, n) in names:
+                    if n == 1:
+                        val = vals[i]
+                    else:
+                        val = vals[i:i + n]
+                    i += n
+                    if name and n:
+                        params[name] = val
+                        parts.append(val)
+            else:
+                (cond, substeps) = step
+                if cond(self):
+                    (pos, buf, done) = self._unpack(substeps, data, pos, buf)
+                    if done:
+                        return (pos, buf, True)
+        return (pos, buf, False)
+
     def handle(self, data):
         """Handle data from a Session class."""
 
@@ -659,18 +2287,28 @@ class Session:
         try:
             saddr = frame.saddr
             try:
-                (f, data) = self.pending.pop(saddr)
+                (f, data, needed, p) = self.pending.pop(saddr)
             except KeyError:
                 f = frame
                 data = gapstr.GapString()
+                needed = 0
+                p = None
             data.extend(gs)
-            try:
-                while data:
-                    p = self.Packet(self, f)
-                    data = p.handle(data)
-                    self.process(p)
-            except NeedMoreData:
-                self.pending[saddr] = (f, data)
+            if len(data) < needed:
+                # Don't bother parsing until there's enough
+                self.pending[saddr] = (f, data, needed, p)
+            else:
+                try:
+                    while data:
+                        if p is None:
+                            p = self.Packet(self, f)
+                        data = p.handle(data)
+                        self.process(p)
+                        p = None
+                except NeedMoreData, e:
+                    if (p is not None) and not p.resumable:
+                        p = None
+                    self.pending[saddr] = (f, data, e.needed or 0, p)
             self.count += 1
         except:
             print ('Lastpos: %r' % (lastpos,))
@@ -764,3 +2402,82 @@ class HtmlSession(Session):
         self.sessfd.write(p.replace('\r\n', '\n'))
         self.sessfd.write('</span>')
             
+
+
+if __name__ == '__main__':
+    import tempfile
+    import shutil
+
+    # A schema with string fields, through Session.process and show()
+    class TestPacket(Packet):
+        fields = (('opcode', 'B'), ('length', 'H'),
+                  Bytes('name', 'length'), ('tag', '2s'), ('pair', '2B'))
+        opcode_field = 'opcode'
+
+        def opcode_1(self):
+            """Name"""
+
+    class TestSession(Session):
+        Packet = TestPacket
+
+    transfers = tempfile.mkdtemp()
+    raw = ('\0' * 12 + '\x08\x00' +
+           struct.pack('!BBHHHBBH4s4s', 0x45, 0, 40, 0, 0, 64, TCP, 0,
+                       '\x0a\0\0\x01', '\x0a\0\0\x02') +
+           struct.pack('!HHIIBBHHH', 1234, 80, 0, 0, 5 << 4, ACK, 0, 0, 0))
+    frame = LazyFrame(((0, 0, len(raw)), raw))
+    out = StringIO.StringIO()
+    sys.stdout = out
+    try:
+        TestSession(frame).handle(0, frame, gapstr.GapString('\x01\x00\x03fooAB\x07\x03'), None)
+    finally:
+        sys.stdout = sys.__stdout__
+        shutil.rmtree(transfers)
+    shown = out.getvalue()
+    assert 'TestPacket   1: Name' in shown
+    assert 'parts: (  1,  3,<3 bytes>,<2 bytes>,(  7,  3)) +0 bytes' in shown
+    assert '66 6f 6f' in shown and '41 42' in shown
+
+    # Flows to one server spread over a power-of-two number of workers
+    flows = [flow_key(0x0a000100 + (i % 7), 40000 + i, 0x0a000002, 80, TCP)
+             for i in range(300)]
+    for n in (2, 4, 8, 16, 32):
+        counts = [0] * n
+        for flow in flows:
+            counts[flow_shard(flow, n)] += 1
+        assert min(counts) > 0 and max(counts) < 3 * len(flows) / n, (n, counts)
+
+    # A session whose client sequence numbers wrap past 2**32
+    def tcp(cli, seq, ack, flags, payload=''):
+        (src, dst, sport, dport) = ('\x0a\0\0\x01', '\x0a\0\0\x02', 1234, 80)
+        if not cli:
+            (src, dst, sport, dport) = (dst, src, dport, sport)
+        raw = ('\0' * 12 + '\x08\x00' +
+               struct.pack('!BBHHHBBH4s4s', 0x45, 0, 40 + len(payload), 0, 0, 64, TCP, 0, src, dst) +
+               struct.pack('!HHIIBBHHH', sport, dport, seq & 0xffffffff, ack & 0xffffffff,
+                           5 << 4, flags, 0, 0, 0) + payload)
+        return LazyFrame(((0, 0, len(raw)), raw))
+    isn = 0xfffffff0
+    tcp_sess = TCP_Resequence()
+    out = [tcp_sess.handle(f) for f in
+           (tcp(1, isn, 0, SYN), tcp(0, 1000, isn + 1, SYN | ACK), tcp(1, isn + 1, 1001, ACK),
+            tcp(1, isn + 1, 1001, ACK, 'a' * 10), tcp(0, 1001, isn + 11, ACK, 'x' * 5),
+            tcp(1, isn + 11, 1006, ACK, 'r' * 20), tcp(0, 1006, isn + 31, ACK, 'y' * 5),
+            tcp(1, isn + 31, 1011, ACK, 's' * 40), tcp(0, 1011, isn + 71, ACK))]
+    assert [str(gs) for (xdi, f, gs) in filter(None, out)] == ['a' * 10, 'x' * 5, 'r' * 20, 'y' * 5, 's' * 40]
+
+    # Sessions with nothing pending get packed, and come back the same
+    class SmallTable(FlowTable):
+        size = 8
+        loose = 1
+    table = SmallTable()
+    packed = {}
+    for i in range(100):
+        key = flow_key(-i, 1024 + i, 0x0a000002, 80, TCP)
+        packed[key] = (i % 3) | ((i & 7) << 2) | ((i & 1) << 5), i - 50, (i << 32) + 1
+        table[key] = TCP_Resequence.unpack(key, *packed[key])
+    assert len(table) == 100 and len(table._objs) == 1
+    for key in sorted(packed):
+        assert table[key].pack(key) == packed[key]
+        assert table.pop(key).pack(key) == packed[key]
+    assert len(table) == 0
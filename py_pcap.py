@@ -1,10 +1,72 @@
 #! /usr/bin/python
 
+import os
 import struct
+import mmap
+import array
+import bisect
+import zlib
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
 
 _MAGIC = 0xA1B2C3D4
+_MAGIC_NSEC = 0xA1B23C4D
+_ZINDEX_MAGIC = 'NAZIDX\0\1'
+
+# pcapng block types
+_NG_SHB = 0x0A0D0D0A
+_NG_IDB = 1
+_NG_OPB = 2
+_NG_SPB = 3
+_NG_EPB = 6
+_NG_BOM = 0x1A2B3C4D
+
+# Record headers, by byte order
+_RECORD = dict((e, struct.Struct(e + 'IIII')) for e in '<>=')
+
+# Array type for batch headers: signed if it's wide enough, since
+# Python 2 hands back longs for 'L'
+_HDRTYPE = 'l'
+if array.array(_HDRTYPE).itemsize < 8:
+    _HDRTYPE = 'L'
+
+# Decompressor factories, by format
+_DECOMPRESSORS = {'gzip': lambda: zlib.decompressobj(16 + zlib.MAX_WBITS)}
+if zstandard:
+    _DECOMPRESSORS['zstd'] = lambda: zstandard.ZstdDecompressor().decompressobj()
+if lz4:
+    _DECOMPRESSORS['lz4'] = lambda: lz4.frame.LZ4FrameDecompressor()
+
+def _compression(head):
+    """Name the compression format head starts with, if any"""
+
+    if head[:2] == '\x1f\x8b':
+        return 'gzip'
+    elif head[:4] == '\x28\xb5\x2f\xfd':
+        return 'zstd'
+    elif head[:4] == '\x04\x22\x4d\x18':
+        return 'lz4'
+
+try:
+    _view = buffer
+except NameError:
+    def _view(obj, offset, size):
+        return memoryview(obj)[offset:offset + size]
 
 class pcap:
+    # Set for pcapng files, whose batches are built a record at a time
+    # and don't know where their records came from
+    pcapng = False
+
+    # Set if packet data are views into a mapping of the file
+    mapped = False
+
     def __init__(self, stream, mode='rb', snaplen=65535, linktype=1):
         try:
             self.stream = file(stream, mode)
@@ -15,17 +77,50 @@ class pcap:
             hdr = self.stream.read(24)
         except IOError:
             hdr = None
+        if hdr and _compression(hdr):
+            self.stream = zfile(self.stream, hdr)
+            hdr = self.stream.read(24)
 
-        if hdr:
+        # Interface of the last packet read; only pcapng has more than one
+        self.interface = 0
+        self.nanosecond = False
+
+        if hdr and (struct.unpack('<I', hdr[:4])[0] == _NG_SHB):
+            # We're reading pcapng.  Sections and interfaces are
+            # remembered by file offset, so seeking around doesn't lose
+            # or repeat them.
+            self._ng_starts = []
+            self._ng_sections = []
+            self._ng_idbs = set()
+            self._ng_scanned = 0
+            pos = self._ng_tell()
+            if pos is not None:
+                pos -= 24
+            self._ng_section(hdr, pos)
+            while not self.linktypes:
+                (btype, _) = self._ng_block()
+                if btype in (None, _NG_EPB, _NG_SPB, _NG_OPB):
+                    raise IOError('No interface description in pcapng file')
+            self.pcapng = True
+            self.read = self._ng_read
+            self.read_batch = self._read_records
+            self.seek = self._ng_seek
+            (self.linktype, self.snaplen, _, _) = self._ng_ifaces[0]
+            self.thiszone = 0
+            self.sigfigs = 0
+            return
+        elif hdr:
             # We're in read mode
             self._endian = None
             for endian in '<>':
                 (self.magic,) = struct.unpack(endian + 'I', hdr[:4])
-                if self.magic == _MAGIC:
+                if self.magic in (_MAGIC, _MAGIC_NSEC):
                     self._endian = endian
                     break
             if not self._endian:
                 raise IOError('Not a pcap file')
+            self._rec = _RECORD[self._endian]
+            self.nanosecond = (self.magic == _MAGIC_NSEC)
             (self.magic, version_major, version_minor,
              self.thiszone, self.sigfigs,
              self.snaplen, self.linktype) = struct.unpack(self._endian + 'IHHIIII', hdr)
@@ -35,6 +130,7 @@ class pcap:
         else:
             # We're in write mode
             self._endian = '='
+            self._rec = _RECORD[self._endian]
             self.magic = _MAGIC
             version_major = 2
             version_minor = 4
@@ -48,22 +144,256 @@ class pcap:
                               self.snaplen, self.linktype)
             self.stream.write(hdr)
         self.version = (version_major, version_minor)
+        self.linktypes = [self.linktype]
 
     def read(self):
         hdr = self.stream.read(16)
         if not hdr:
             return
-        (tv_sec, tv_usec, caplen, length) = struct.unpack(self._endian + 'IIII', hdr)
+        (tv_sec, tv_usec, caplen, length) = self._rec.unpack(hdr)
+        if self.nanosecond:
+            tv_usec //= 1000
         datum = self.stream.read(caplen)
         return ((tv_sec, tv_usec, length), datum)
 
+    ##
+    ## pcapng
+    ##
+
+    def _ng_tell(self):
+        try:
+            return self.stream.tell()
+        except (IOError, AttributeError):
+            return None
+
+    def _ng_section(self, hdr, pos=None):
+        """Start a pcapng section, given the first 24 octets of its SHB at pos"""
+
+        if pos in self._ng_starts:
+            # Been here before
+            i = self._ng_starts.index(pos)
+            (_, length) = struct.unpack(self._ng_sections[i][0] + 'II', hdr[:8])
+            self.stream.read(length - 24)
+            self._ng_use(i)
+            return
+        self._endian = None
+        for endian in '<>':
+            (magic,) = struct.unpack(endian + 'I', hdr[8:12])
+            if magic == _NG_BOM:
+                self._endian = endian
+                break
+        if not self._endian:
+            raise IOError('Not a pcap file')
+        (_, length, self.magic,
+         version_major, version_minor) = struct.unpack(self._endian + 'IIIHH', hdr[:16])
+        if version_major != 1:
+            raise IOError('Cannot handle pcapng version %d.%d' % (version_major,
+                                                                  version_minor))
+        self.stream.read(length - 24)
+        self.version = (version_major, version_minor)
+        # (linktype, snaplen, ticks per second, offset in seconds) by interface
+        self._ng_ifaces = []
+        self.linktypes = []
+        if pos is not None:
+            self._ng_starts.append(pos)
+            self._ng_sections.append((self._endian, self.version,
+                                      self._ng_ifaces, self.linktypes))
+            self._ng_scanned = max(self._ng_scanned, pos + length)
+
+    def _ng_use(self, i):
+        """Switch to section i"""
+
+        (self._endian, self.version,
+         self._ng_ifaces, self.linktypes) = self._ng_sections[i]
+
+    def _ng_interface(self, body, pos=None):
+        if pos is not None:
+            if pos in self._ng_idbs:
+                return
+            self._ng_idbs.add(pos)
+        (linktype, _, snaplen) = struct.unpack_from(self._endian + 'HHI', body)
+        units = 1000000
+        offset = 0
+        pos = 8
+        while pos + 4 <= len(body):
+            (code, length) = struct.unpack_from(self._endian + 'HH', body, pos)
+            pos += 4
+            if code == 0:
+                break
+            elif code == 9:
+                # if_tsresol
+                resol = ord(body[pos])
+                if resol & 0x80:
+                    units = 2 ** (resol & 0x7f)
+                else:
+                    units = 10 ** resol
+            elif code == 14:
+                # if_tsoffset
+                (offset,) = struct.unpack_from(self._endian + 'q', body, pos)
+            pos += (length + 3) & ~3
+        self._ng_ifaces.append((linktype, snaplen, units, offset))
+        self.linktypes.append(linktype)
+
+    def _ng_time(self, iface, ts_high, ts_low):
+        try:
+            (_, _, units, offset) = self._ng_ifaces[iface]
+        except IndexError:
+            raise IOError('No interface %d in pcapng section' % iface)
+        (tv_sec, frac) = divmod((ts_high << 32) | ts_low, units)
+        if units != 1000000:
+            frac = frac * 1000000 // units
+        return (tv_sec + offset, frac)
+
+    def _ng_block(self):
+        """Read one pcapng block, returning (type, body).
+
+        Section headers and interface descriptions are taken care of
+        here.
+
+        """
+
+        pos = self._ng_tell()
+        hdr = self.stream.read(8)
+        if len(hdr) < 8:
+            return (None, None)
+        (btype, length) = struct.unpack(self._endian + 'II', hdr)
+        if btype == _NG_SHB:
+            self._ng_section(hdr + self.stream.read(16), pos)
+            return (btype, None)
+        body = self.stream.read(length - 8)
+        if btype == _NG_IDB:
+            self._ng_interface(body, pos)
+        if pos is not None:
+            self._ng_scanned = max(self._ng_scanned, pos + length)
+        return (btype, body)
+
+    def _ng_seek(self, pos):
+        if pos > self._ng_scanned:
+            # Pick up the sections and interfaces being skipped over
+            self.stream.seek(self._ng_scanned)
+            while self._ng_scanned < pos:
+                if self._ng_block()[0] is None:
+                    break
+        self.stream.seek(pos)
+        self._ng_use(bisect.bisect_right(self._ng_starts, pos) - 1)
+
+    def _ng_read(self):
+        """Read pcapng blocks until one has a packet in it"""
+
+        while True:
+            (btype, body) = self._ng_block()
+            if btype is None:
+                return
+            elif btype == _NG_EPB:
+                (iface, ts_high, ts_low,
+                 caplen, length) = struct.unpack_from(self._endian + 'IIIII', body)
+                self.interface = iface
+                datum = body[20:20 + caplen]
+            elif btype == _NG_SPB:
+                # No timestamp, and the snaplen of interface 0 applies
+                (length,) = struct.unpack_from(self._endian + 'I', body)
+                (_, snaplen, _, _) = self._ng_ifaces[0]
+                self.interface = iface = 0
+                ts_high = ts_low = 0
+                datum = body[4:4 + min(length, snaplen or length, len(body) - 8)]
+            elif btype == _NG_OPB:
+                (iface, _, ts_high, ts_low,
+                 caplen, length) = struct.unpack_from(self._endian + 'HHIIII', body)
+                self.interface = iface
+                datum = body[20:20 + caplen]
+            else:
+                continue
+            return (self._ng_time(iface, ts_high, ts_low) + (length,), datum)
+
     def write(self, packet):
         (header, datum) = packet
         (tv_sec, tv_usec, length) = header
-        hdr = struct.pack(self._endian + 'IIII', tv_sec, tv_usec, length, len(datum))
+        hdr = self._rec.pack(tv_sec, tv_usec, len(datum), length)
         self.stream.write(hdr)
         self.stream.write(datum)
 
+    def _scan(self, b, pos, end, n):
+        """Add up to n complete records from b.buf[pos:end] to b.
+
+        Returns the position after the last record added.
+
+        """
+
+        unpack_from = self._rec.unpack_from
+        buf = b.buf
+        hdrs = b.hdrs
+        nanosecond = self.nanosecond
+        while n and pos + 16 <= end:
+            (tv_sec, tv_usec, caplen, length) = unpack_from(buf, pos)
+            if pos + 16 + caplen > end:
+                break
+            if nanosecond:
+                tv_usec //= 1000
+            pos += 16
+            hdrs.extend((tv_sec, tv_usec, caplen, length, pos))
+            pos += caplen
+            n -= 1
+        return pos
+
+    def read_batch(self, n, bufsize=1 << 20):
+        """Read up to n records in one go, returning a batch."""
+
+        try:
+            base = self.stream.tell()
+        except (IOError, AttributeError):
+            # Can't put back what we over-read
+            return self._read_records(n)
+
+        b = batch(self.stream.read(bufsize), base)
+        pos = self._scan(b, 0, len(b.buf), n)
+        while len(b) < n:
+            more = self.stream.read(max(bufsize, len(b.buf)))
+            if not more:
+                break
+            b.buf += more
+            pos = self._scan(b, pos, len(b.buf), n - len(b))
+        if pos != len(b.buf):
+            self.stream.seek(base + pos)
+        return b
+
+    def _read_records(self, n, bufsize=None):
+        """Build a batch a record at a time with read()"""
+
+        b = batch('')
+        parts = []
+        pos = 0
+        for i in xrange(n):
+            r = self.read()
+            if not r:
+                break
+            ((tv_sec, tv_usec, length), datum) = r
+            b.hdrs.extend((tv_sec, tv_usec, len(datum), length, pos))
+            parts.append(datum)
+            pos += len(datum)
+        b.buf = ''.join(parts)
+        return b
+
+    def write_batch(self, packets):
+        """Write a sequence of packets with a single write."""
+
+        packets = list(packets)
+        pack_into = self._rec.pack_into
+        buf = bytearray(sum(16 + len(datum) for (_, datum) in packets))
+        pos = 0
+        for ((tv_sec, tv_usec, length), datum) in packets:
+            caplen = len(datum)
+            pack_into(buf, pos, tv_sec, tv_usec, caplen, length)
+            pos += 16
+            buf[pos:pos + caplen] = datum
+            pos += caplen
+        self.stream.write(buf)
+
+    def tell(self):
+        return self.stream.tell()
+
+    def seek(self, pos):
+        self.stream.seek(pos)
+
     def __iter__(self):
         while True:
             r = self.read()
@@ -72,8 +402,295 @@ class pcap:
             yield r
 
 
+class mmap_pcap(pcap):
+    """Read-only pcap reader over a memory-mapped file.
+
+    Record headers are decoded straight out of the mapping, and the
+    data part of each record is a view into it rather than a copy.
+    tell() and seek() work on file offsets without touching the file.
+
+    """
+
+    def __init__(self, stream):
+        try:
+            self.fd = file(stream, 'rb')
+        except TypeError:
+            self.fd = stream
+        pcap.__init__(self, self.fd)
+        self.mapped = not self.pcapng
+        self.stream = mmap.mmap(self.fd.fileno(), 0, access=mmap.ACCESS_READ)
+        self._pos = self.fd.tell()
+        self._size = len(self.stream)
+        if self.pcapng:
+            # Read blocks out of the mapping like a file
+            self.stream.seek(self._pos)
+            self.tell = self.stream.tell
+
+    def read(self):
+        pos = self._pos
+        if pos + 16 > self._size:
+            return
+        (tv_sec, tv_usec, caplen, length) = self._rec.unpack_from(self.stream, pos)
+        if self.nanosecond:
+            tv_usec //= 1000
+        pos += 16
+        self._pos = min(pos + caplen, self._size)
+        return ((tv_sec, tv_usec, length), _view(self.stream, pos, self._pos - pos))
+
+    def read_batch(self, n, bufsize=None):
+        b = batch(self.stream)
+        self._pos = self._scan(b, self._pos, self._size, n)
+        return b
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, pos):
+        self._pos = pos
+
+
+class zfile:
+    """Read-only file object over a compressed stream.
+
+    Decompression reads bufsize octets of the underlying file at a
+    time.  Every interval octets of output, the decompressor state is
+    copied into index, so seek() only has to inflate from the nearest
+    checkpoint rather than from the start.  Formats whose decompressor
+    can't be copied (zstd, lz4) only get checkpoints where a member or
+    frame starts.
+
+    Member starts are all that can be saved for another process:
+    save_index() writes them, and they're loaded again from raw's name
+    plus '.zidx' if that's newer than raw.  Files compressed in many
+    members (bgzip, pigz --independent, zstd in frames) can then be
+    seeked into without inflating everything before.
+
+    head is anything already read from the start of raw.
+
+    """
+
+    def __init__(self, raw, head='', bufsize=1 << 20, interval=1 << 26):
+        self.raw = raw
+        head = head or raw.read(4)
+        self.codec = _compression(head)
+        try:
+            self._new = _DECOMPRESSORS[self.codec]
+        except KeyError:
+            raise IOError('No decompressor for %s' % self.codec)
+        self.bufsize = bufsize
+        self.interval = interval
+        try:
+            start = raw.tell() - len(head)
+        except (IOError, AttributeError):
+            start = None
+        # (uncompressed offset, raw offset, decompressor state), where
+        # the state is None at the start of a member
+        self.index = [(0, start, None)]
+        self._upos = [0]
+        self._dec = self._new()
+        self._head = head
+        self._buf = ''
+        self._bufpos = 0
+        self._base = 0      # Uncompressed offset of _buf[0]
+        self._eof = False
+        name = getattr(raw, 'name', None)
+        if (start is not None) and isinstance(name, str):
+            try:
+                if os.path.getmtime(name + '.zidx') >= os.path.getmtime(name):
+                    self.load_index(name + '.zidx')
+            except (OSError, IOError, struct.error):
+                pass
+
+    def _checkpoint(self, upos, rpos, dec=None):
+        """Note that decompression can start over at upos from rpos.
+
+        dec is the decompressor there, or None at the start of a member.
+        A decompressor is only copied if the last checkpoint is more than
+        interval back.
+
+        """
+
+        i = bisect.bisect_right(self._upos, upos)
+        if i and (self._upos[i - 1] == upos):
+            return
+        if dec is not None:
+            if upos < self._upos[i - 1] + self.interval:
+                return
+            dec = dec.copy()
+        self._upos.insert(i, upos)
+        self.index.insert(i, (upos, rpos, dec))
+
+    def _decompress(self, data):
+        out = [self._dec.decompress(data)]
+        while getattr(self._dec, 'unused_data', None):
+            # Another member or frame follows
+            data = self._dec.unused_data
+            self._dec = self._new()
+            try:
+                self._checkpoint(self._base + len(self._buf) + sum(map(len, out)),
+                                 self.raw.tell() - len(data))
+            except (IOError, AttributeError):
+                pass
+            out.append(self._dec.decompress(data))
+        return ''.join(out)
+
+    def save_index(self, fn):
+        """Save where members start, as far as they've been read"""
+
+        marks = [(upos, rpos) for (upos, rpos, state) in self.index
+                 if (state is None) and (rpos is not None)]
+        fd = file(fn, 'wb')
+        fd.write(struct.pack('<8sQ', _ZINDEX_MAGIC, len(marks)))
+        for mark in marks:
+            fd.write(struct.pack('<QQ', *mark))
+        fd.close()
+
+    def load_index(self, fn):
+        fd = file(fn, 'rb')
+        (magic, count) = struct.unpack('<8sQ', fd.read(16))
+        if magic != _ZINDEX_MAGIC:
+            raise IOError('Not a compressed file index')
+        for i in xrange(count):
+            self._checkpoint(*struct.unpack('<QQ', fd.read(16)))
+        fd.close()
+
+    def _fill(self):
+        """Decompress more data into _buf, keeping up to bufsize already read"""
+
+        while not self._eof:
+            data = self._head or self.raw.read(self.bufsize)
+            self._head = ''
+            if not data:
+                self._eof = True
+                break
+            out = self._decompress(data)
+            if not out:
+                continue
+            keep = min(self._bufpos, self.bufsize)
+            drop = self._bufpos - keep
+            self._buf = self._buf[drop:] + out
+            self._bufpos -= drop
+            self._base += drop
+            end = self._base + len(self._buf)
+            try:
+                self._checkpoint(end, self.raw.tell(), self._dec)
+            except (IOError, AttributeError):
+                pass
+            return True
+        return False
+
+    def read(self, n=-1):
+        buf = self._buf
+        pos = self._bufpos
+        if 0 <= n <= len(buf) - pos:
+            self._bufpos = pos + n
+            return buf[pos:pos + n]
+
+        parts = [buf[pos:]]
+        self._bufpos = len(buf)
+        got = len(parts[0])
+        while (n < 0 or got < n) and self._fill():
+            want = len(self._buf) - self._bufpos
+            if n >= 0:
+                want = min(want, n - got)
+            parts.append(self._buf[self._bufpos:self._bufpos + want])
+            self._bufpos += want
+            got += want
+        return ''.join(parts)
+
+    def tell(self):
+        return self._base + self._bufpos
+
+    def seek(self, pos, whence=0):
+        if whence == 1:
+            pos += self.tell()
+        elif whence == 2:
+            raise IOError('Cannot seek from the end of a compressed file')
+        if self._base <= pos <= self._base + len(self._buf):
+            self._bufpos = pos - self._base
+            return
+        i = bisect.bisect_right(self._upos, pos) - 1
+        if pos < self._base or self.index[i][0] > self._base + len(self._buf):
+            # Start over from the nearest checkpoint
+            (upos, rpos, state) = self.index[i]
+            if rpos is None:
+                raise IOError('Cannot seek backwards in this stream')
+            self.raw.seek(rpos)
+            if state:
+                self._dec = state.copy()
+            else:
+                self._dec = self._new()
+            self._head = ''
+            self._eof = False
+            self._buf = ''
+            self._bufpos = 0
+            self._base = upos
+        self._bufpos = len(self._buf)
+        while self._base + len(self._buf) < pos and self._fill():
+            self._bufpos = len(self._buf)
+        self._bufpos = min(pos - self._base, len(self._buf))
+
+
+class batch:
+    """A block of records read in one pass.
+
+    buf holds the raw records, and hdrs is a flat array of
+    (ts_sec, ts_usec, caplen, len, offset) for each record, where
+    offset is the start of the record data within buf.  base is the
+    file offset of buf[0].
+
+    """
+
+    def __init__(self, buf, base=0):
+        self.buf = buf
+        self.base = base
+        self.hdrs = array.array(_HDRTYPE)
+
+    def __len__(self):
+        return len(self.hdrs) // 5
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if not (0 <= idx < len(self)):
+            raise IndexError()
+        (tv_sec, tv_usec, caplen, length, offset) = self.hdrs[idx * 5:idx * 5 + 5]
+        return ((tv_sec, tv_usec, length), _view(self.buf, offset, caplen))
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def tell(self, idx):
+        """File offset of record idx"""
+
+        return self.base + self.hdrs[idx * 5 + 4] - 16
+
+
+def open_offline(stream, mapped=False):
+    """Open a capture for reading.
+
+    If mapped is true, the file is memory-mapped and packet data is
+    returned as views into the mapping.  Compressed captures are never
+    mapped.
+
+    """
+
+    if mapped:
+        try:
+            fd = file(stream, 'rb')
+        except TypeError:
+            fd = stream
+        pos = fd.tell()
+        head = fd.read(4)
+        fd.seek(pos)
+        if not _compression(head):
+            return mmap_pcap(fd)
+        stream = fd
+    return pcap(stream)
+
+
 open = pcap
-open_offline = pcap
 
 
 if __name__ == '__main__':
@@ -85,3 +702,55 @@ if __name__ == '__main__':
     assert ((p.version, p.thiszone, p.sigfigs, p.snaplen, p.linktype) ==
             ((2, 4), 0, 0, 65535, 1))
     assert ([i for i in p] == [((0, 0, 3), 'foo'), ((0, 0, 3), 'bar')])
+    p = open_offline('test.pcap', mapped=True)
+    assert p.tell() == 24
+    assert ([(h, str(d)) for (h, d) in p] == [((0, 0, 3), 'foo'), ((0, 0, 3), 'bar')])
+    p.seek(43)
+    assert str(p.read()[1]) == 'bar'
+    for p in (open('test.pcap'), open_offline('test.pcap', mapped=True)):
+        b = p.read_batch(1)
+        assert (len(b), b.tell(0), p.tell()) == (1, 24, 43)
+        b = p.read_batch(5)
+        assert [(h, str(d)) for (h, d) in b] == [((0, 0, 3), 'bar')]
+        assert str(b[-1][1]) == 'bar'
+        assert not p.read_batch(5)
+
+    f = file('test.pcap', 'wb')         # Nanosecond timestamps
+    f.write(struct.pack('<IHHIIII', _MAGIC_NSEC, 2, 4, 0, 0, 65535, 1))
+    f.write(struct.pack('<IIII', 1, 999999999, 3, 3) + 'foo')
+    f.close()
+    p = open('test.pcap')
+    assert p.nanosecond and p.read() == ((1, 999999, 3), 'foo')
+
+    def block(btype, body):             # pcapng, two interfaces
+        return struct.pack('<II', btype, len(body) + 12) + body + struct.pack('<I', len(body) + 12)
+    ng = [block(_NG_SHB, struct.pack('<IHHq', _NG_BOM, 1, 0, -1)),
+          block(_NG_IDB, struct.pack('<HHI', 1, 0, 65535)),
+          block(_NG_EPB, struct.pack('<IIIII', 0, 0, 1000001, 3, 3) + 'foo\0'),
+          block(_NG_IDB, struct.pack('<HHIHHB3xHH', 101, 0, 65535, 9, 1, 9, 0, 0)),
+          block(_NG_EPB, struct.pack('<IIIII', 1, 0, 2000000000, 3, 3) + 'bar\0')]
+    file('test.pcapng', 'wb').write(''.join(ng))
+    last = len(''.join(ng[:4]))
+    for p in (open('test.pcapng'), open_offline('test.pcapng', mapped=True)):
+        p.seek(last)                    # Past the second IDB
+        assert p.read() == ((2, 0, 3), 'bar') and p.interface == 1
+        p.seek(0)                       # Back over both IDBs
+        assert [r for (r, _) in p] == [(1, 1, 3), (2, 0, 3)]
+        assert p.linktypes == [1, 101]
+
+    import gzip                         # Compressed captures
+    gzip.open('test.pcap.gz', 'wb').write(file('test.pcap', 'rb').read())
+    p = open('test.pcap.gz')
+    assert p.nanosecond and p.read() == ((1, 999999, 3), 'foo')
+    p.seek(24)
+    assert p.read() == ((1, 999999, 3), 'foo')
+    g = gzip.open('test.pcap.gz', 'ab')  # A second member, found again
+    g.write(struct.pack('<IIII', 2, 0, 3, 3) + 'bar')
+    g.close()
+    p = open('test.pcap.gz')
+    assert [d for (_, d) in p] == ['foo', 'bar']
+    p.stream.save_index('test.pcap.gz.zidx')
+    z = zfile(file('test.pcap.gz', 'rb'))
+    assert [u for (u, _, _) in z.index] == [0, 43]
+    z.seek(43)
+    assert z.read(4) == '\x02\0\0\0'